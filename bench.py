@@ -0,0 +1,192 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+#Benchmark of HTML Gallery Generator. It generates a synthetic gallery, then times hgg.py in the following scenarios:
+#  cold -- the first generation of the gallery
+#  noop -- generation without any change
+#  incremental -- generation after a single image is modified
+#  template -- generation after the template is modified, which regenerates all web files
+#  gc -- generation with -gc after a directory is removed
+#The results are written as JSON, which can be compared with -compare
+
+import os, sys, json, random, shutil, subprocess, tempfile, time, platform
+from PIL import Image, ImageDraw
+
+SCENARIOS = ['cold', 'noop', 'incremental', 'template', 'gc']
+VALUE_OPTIONS = ['depth', 'fanout', 'files', 'image-size', 'mix', 'template', 'j', 'hgg-args', 'repeat', 'seed', 'out', 'keep', 'compare']
+HGG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hgg.py')
+
+#Parse `jpg=8,png=1,txt=1` into a list of (extension, weight)
+def parseMix(mix):
+	ret = []
+	for item in mix.split(','):
+		ext, weight = item.split('=')
+		ret.append(('.'+ext.lstrip('.').lower(), float(weight)))
+	return ret
+
+#Write a file of `ext` with random content. Images are real images so that the thumbnails are generated. The other files are random bytes
+def writeSyntheticFile(path, ext, imageSize, rng):
+	if ext in ['.jpg', '.png']:
+		im = Image.new('RGB', imageSize, tuple([rng.randrange(256) for i in range(3)]))
+		draw = ImageDraw.Draw(im)
+		for i in range(8): #Make the content of each image unique
+			x, y = rng.randrange(imageSize[0]), rng.randrange(imageSize[1])
+			draw.rectangle([x, y, x+imageSize[0]//4, y+imageSize[1]//4], fill=tuple([rng.randrange(256) for i in range(3)]))
+		im.save(path, 'JPEG' if ext == '.jpg' else 'PNG')
+	else:
+		with open(path, 'wb') as f:
+			f.write(bytes([rng.randrange(256) for i in range(1024)]))
+
+#Generate <dest>/assets with `depth` levels of directories. Each directory has `fanout` subdirectories and `files` files
+#Returns the number of files and directories generated
+def generateGallery(dest, depth, fanout, files, imageSize, mix, seed):
+	rng = random.Random(seed)
+	extensions = [ext for ext, weight in mix]
+	weights = [weight for ext, weight in mix]
+	numFiles = 0
+	numDirs = 0
+	pending = [('', 0)]
+	while len(pending) > 0:
+		rel, level = pending.pop()
+		path = os.path.join(dest, 'assets', rel)
+		os.makedirs(path, exist_ok=True)
+		numDirs += 1
+		for i in range(files):
+			ext = rng.choices(extensions, weights)[0]
+			writeSyntheticFile(os.path.join(path, 'file{0:05d}{1}'.format(i, ext)), ext, imageSize, rng)
+			numFiles += 1
+		if level < depth:
+			pending += [(os.path.join(rel, 'dir{0:03d}'.format(i)), level+1) for i in range(fanout)]
+	return numFiles, numDirs
+
+#Run hgg.py and returns the elapsed time in seconds
+def runHgg(dest, template, hggArgs):
+	start = time.perf_counter()
+	result = subprocess.run([sys.executable, HGG_PATH, dest, template]+hggArgs, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+	elapsed = time.perf_counter()-start
+	if result.returncode != 0:
+		raise Exception('Error: hgg.py failed:\n'+result.stderr.decode('utf-8', 'replace'))
+	return elapsed
+
+#Run all scenarios once on a newly generated gallery in `workDir`. Returns scenario -> elapsed time
+def runScenarios(workDir, config, rng):
+	dest = os.path.join(workDir, 'gallery')
+	template = os.path.join(workDir, 'template'+os.path.splitext(config['template'])[1])
+	if os.path.exists(dest):
+		shutil.rmtree(dest)
+	shutil.copyfile(config['template'], template)
+	config['numFiles'], config['numDirs'] = generateGallery(dest, config['depth'], config['fanout'], config['files'], config['imageSize'], config['mix'], config['seed'])
+	hggArgs = config['hggArgs']
+	ret = {}
+
+	ret['cold'] = runHgg(dest, template, hggArgs)
+	ret['noop'] = runHgg(dest, template, hggArgs)
+
+	images = [os.path.join(root, f) for root, dirs, files in os.walk(os.path.join(dest, 'assets')) for f in files if os.path.splitext(f)[1] in ['.jpg', '.png']]
+	if len(images) > 0:
+		image = sorted(images)[rng.randrange(len(images))]
+		writeSyntheticFile(image, os.path.splitext(image)[1], config['imageSize'], rng)
+		st = os.stat(image)
+		os.utime(image, (st.st_atime, st.st_mtime+1)) #Make sure that the mtime is changed even on file systems with coarse timestamps
+	ret['incremental'] = runHgg(dest, template, hggArgs)
+
+	with open(template, 'a') as f:
+		f.write('\n<!-- modified by bench.py -->\n')
+	ret['template'] = runHgg(dest, template, hggArgs)
+
+	dirs = sorted([d for d in os.listdir(os.path.join(dest, 'assets')) if os.path.isdir(os.path.join(dest, 'assets', d))])
+	if len(dirs) > 0:
+		shutil.rmtree(os.path.join(dest, 'assets', dirs[-1]))
+	ret['gc'] = runHgg(dest, template, hggArgs+['-gc'])
+	return ret
+
+def getVersion():
+	try:
+		return subprocess.run(['git', '-C', os.path.dirname(HGG_PATH), 'describe', '--always', '--dirty'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode().strip()
+	except OSError:
+		return ''
+
+def benchmark(config, keep):
+	workDir = keep if keep != None else tempfile.mkdtemp(prefix='hgg-bench-')
+	os.makedirs(workDir, exist_ok=True)
+	rng = random.Random(config['seed'])
+	times = dict([(s, []) for s in SCENARIOS])
+	try:
+		for i in range(config['repeat']):
+			print('Run {0}/{1}...'.format(i+1, config['repeat']))
+			for scenario, elapsed in runScenarios(workDir, config, rng).items():
+				times[scenario].append(elapsed)
+				print('  {0:<12} {1:8.3f}s'.format(scenario, elapsed))
+	finally:
+		if keep == None:
+			shutil.rmtree(workDir)
+	return {'version': getVersion(), 'python': platform.python_version(), 'platform': platform.platform(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'config': config, 'results': dict([(s, {'times': times[s], 'min': min(times[s])}) for s in SCENARIOS])}
+
+#Print the minimum time of each scenario of the two results, and the ratio new/old
+def compare(oldPath, newPath):
+	with open(oldPath) as f:
+		old = json.load(f)
+	with open(newPath) as f:
+		new = json.load(f)
+	if old['config'] != new['config']:
+		print('Warning: the results are measured with different configurations')
+	print('{0:<12} {1:>10} {2:>10} {3:>8}'.format('scenario', old['version'] or 'old', new['version'] or 'new', 'ratio'))
+	for s in SCENARIOS:
+		if s in old['results'] and s in new['results']:
+			a, b = old['results'][s]['min'], new['results'][s]['min']
+			print('{0:<12} {1:9.3f}s {2:9.3f}s {3:7.2f}x'.format(s, a, b, b/a if a > 0 else float('inf')))
+
+config = {'depth': 2, 'fanout': 3, 'files': 20, 'imageSize': (1600, 1200), 'mix': [('.jpg', 8), ('.png', 1), ('.txt', 1)], 'template': os.path.join(os.path.dirname(HGG_PATH), 'template.html'), 'hggArgs': [], 'repeat': 1, 'seed': 9001}
+outPath = None
+keep = None
+comparePaths = None
+invalidArguments = False
+
+options = []
+parameters = []
+arguments = iter(sys.argv[1:])
+for a in arguments:
+	if a[0] == '-':
+		options.append((a[1:], next(arguments, None) if a[1:] in VALUE_OPTIONS else None))
+	else:
+		parameters.append(a)
+for o, value in options:
+	try:
+		if o in ['depth', 'fanout', 'files', 'repeat', 'seed']:
+			config[o] = int(value)
+		elif o == 'image-size':
+			config['imageSize'] = tuple([int(i) for i in value.split('x')])
+		elif o == 'mix':
+			config['mix'] = parseMix(value)
+		elif o == 'template':
+			config['template'] = os.path.abspath(value)
+		elif o == 'j':
+			config['hggArgs'] += ['-j', str(int(value))]
+		elif o == 'hgg-args':
+			config['hggArgs'] += value.split()
+		elif o == 'out':
+			outPath = value
+		elif o == 'keep':
+			keep = os.path.abspath(value)
+		elif o == 'compare':
+			comparePaths = [value]+parameters
+		else:
+			print('Unknown option -'+o)
+			invalidArguments = True
+	except (TypeError, ValueError, AttributeError):
+		print('Invalid value of option -'+o)
+		invalidArguments = True
+
+if invalidArguments or (comparePaths != None and len(comparePaths) != 2) or (comparePaths == None and len(parameters) > 0):
+	print('HTML Gallery Generator benchmark')
+	print('Usage: '+sys.argv[0]+' [-depth N] [-fanout N] [-files N] [-image-size WxH] [-mix jpg=8,png=1,txt=1] [-template <template>] [-j N] [-hgg-args "<args>"] [-repeat N] [-seed N] [-keep <dir>] [-out <result.json>]')
+	print('       '+sys.argv[0]+' -compare <old.json> <new.json>')
+	sys.exit(1)
+elif comparePaths != None:
+	compare(*comparePaths)
+else:
+	result = benchmark(config, keep)
+	if outPath != None:
+		with open(outPath, 'w') as f:
+			json.dump(result, f, indent='\t')
+		print('Results written to '+outPath)
@@ -21,6 +21,19 @@ TIME_FORMAT = '%y-%m-%d'
 SHUFFLE_SEED = 9001 #The seed of randomizing the order of thumbnails. Not very useful
 DATABASE_FLUST_INTERVAL = 60 #The interval of saving the database, in seconds
 THUMBNAIL_SIZE = (256, 256)
+THUMBNAIL_DENSITIES = [1] #The pixel densities of the thumbnails. Must include 1. For example, [1, 2] also generates the thumbnails of twice THUMBNAIL_SIZE in ./thumbnails@2x for high-DPI screens
+THUMBNAIL_WEBP = False #If true, the thumbnails are also generated in WebP format(<file>.webp) besides JPEG(<file>.jpg)
+THUMBNAIL_DRAFT = True #Decode the JPEG images at 1/2, 1/4 or 1/8 of the size that is still larger than THUMBNAIL_SIZE. Much faster for large photos
+THUMBNAIL_RESIZE = 'lanczos' #The resize backend of the thumbnails. One of lanczos, bicubic, bilinear and reduce. See RESIZE_BACKENDS
+SHARD_COMMAND = None #The command running the worker of a shard of -shards, e.g. 'ssh node{i} python3 /path/to/hgg.py {args}'. {i} is the shard number and {args} are the arguments of the worker. The nodes must share <dest> at the same path. If None, the workers are local processes
+CONVERSION_TIMEOUT = 3600 #The conversion commands running longer than this are killed, in seconds. 0 means no timeout
+WATCH_DEBOUNCE = 2 #With -watch, the gallery is regenerated after no more changes are made for this period, in seconds
+STAT_THREADS = 16 #The number of threads getting the metadata of the files concurrently. Increase it if the gallery is on a network file system, e.g. NFS
+STATS_SLOWEST_FILES = 20 #The number of the slowest files of each kind listed in the report of -stats
+SPRITE_COLUMNS = 0 #If positive, the thumbnails of each directory are also packed into sprite sheets of this number of columns in ./sprites. See spriteUrl of `for files`. Run with -regen-web-files after changing it
+SPRITE_ROWS = 16 #The maximum number of rows of a sprite sheet. The thumbnails of a larger directory are packed into multiple sprite sheets
+COVER_MOSAIC = 0 #If positive, the covers of each directory are also composited into a mosaic of COVER_MOSAIC*COVER_MOSAIC thumbnails in ./covers. See mosaic of `for files`. Run with -regen-web-files after changing it
+FILES_PER_PAGE = 0 #The average number of items of `for files` in each page of a directory. 0 means all items are shown in one page. Run with -regen-web-files after changing it
 
 #Depending on the packages you have installed, you may want to modify these lists
 SHOW_UNSUPPORTED_FORMATS = True #If false, unsupported file format are hidden in the gallery
@@ -34,9 +47,9 @@ SUPPORTED_FORMATS = MEDIA_FORMATS+SUPPORTED_MISC_FORMATS
 ###  END OF CONFIGURATION  ###
 ##############################
 
-import os, sys, hashlib, shutil, re, random, time, io, urllib.request
+import os, sys, hashlib, shutil, re, random, time, io, zlib, struct, json, heapq, pickle, sqlite3, cProfile, select, ctypes, ctypes.util, urllib.request, multiprocessing, subprocess, signal, concurrent.futures
 from xml.sax.saxutils import escape
-from PIL import Image
+from PIL import Image, ImageOps, features
 import gi
 gi.require_version('Gst', '1.0')
 from gi.repository import GObject, Gst
@@ -60,6 +73,14 @@ You may want to put css and js files into ./ for your webpage files. All webpage
 
 BLOCK_ELEMENTS = ['for', 'if']
 
+#Each resize backend shrinks the image to fit within the size, in place. reducing_gap is None because the JPEG images are already reduced by draft()
+RESIZE_BACKENDS = {
+	'lanczos': lambda im, size: im.thumbnail(size, Image.LANCZOS, None),
+	'bicubic': lambda im, size: im.thumbnail(size, Image.BICUBIC, None),
+	'bilinear': lambda im, size: im.thumbnail(size, Image.BILINEAR, None),
+	'reduce': lambda im, size: im.thumbnail(size, Image.BICUBIC, 2.0), #Reduces the image by an integer factor before resampling. The fastest one
+}
+
 ####################
 ###Util functions###
 ####################
@@ -88,12 +109,27 @@ def humanReadable(num, suffix='B'):
 		num /= 1024.0
 	return "%.1f%s%s" % (num, 'Yi', suffix)
 
-#Get all files in the directory recursively. Stolen from https://stackoverflow.com/questions/18394147/recursive-sub-folder-search-and-return-files-in-a-list-python/18394205#18394205
-def getFilesRecursive(func, path):
-	return [func(dp, dn, filenames, f) for dp, dn, filenames in os.walk(path) for f in filenames]
+def isShownFile(fn):
+	return (os.path.splitext(fn)[1].lower() in SUPPORTED_FORMATS) or SHOW_UNSUPPORTED_FORMATS
+
+#A fast content hash of a file
+def fileHash(path):
+	h = hashlib.blake2b(digest_size=16)
+	with open(path, 'rb') as f:
+		for chunk in iter(lambda: f.read(1<<20), b''):
+			h.update(chunk)
+	return h.hexdigest()
+
+#os.stat(), or None if the file does not exist
+def statOrNone(path):
+	try:
+		return os.stat(path)
+	except FileNotFoundError:
+		return None
 
-def getDirectoryItemsNum(path):
-	return len([fn for fn in getFilesRecursive(lambda a,b,c,fn:fn, path) if ((os.path.splitext(fn)[1].lower() in SUPPORTED_FORMATS) or SHOW_UNSUPPORTED_FORMATS)])
+def listDirEntries(path):
+	with os.scandir(path) as it:
+		return list(it)
 
 def shellEscape(arg):
 	return '"'+arg.replace('\\', '\\\\').replace('"', '\\"')+'"'
@@ -101,73 +137,313 @@ def shellEscape(arg):
 def rootRelNoSlash(rootRel):
 	return (rootRel+'/' if rootRel != '' else '')
 
-#Take a video capture in the beginning of the video
+probePipeline = None #The playbin reused by probeMedia(). Each process creates its own one
+probePipelinePid = None
+
+def getProbePipeline():
+	global probePipeline, probePipelinePid
+	if probePipeline == None or probePipelinePid != os.getpid(): #A pipeline inherited from the parent process is not usable
+		probePipeline = Gst.parse_launch('playbin')
+		probePipeline.props.audio_sink = Gst.ElementFactory.make('fakesink', 'fakeaudio')
+		probePipeline.props.video_sink = Gst.ElementFactory.make('fakesink', 'fakevideo')
+		probePipelinePid = os.getpid()
+	return probePipeline
+
+#Get the duration(in seconds), the dimension and optionally a JPEG capture in the beginning of the media with a single preroll
+#Unavailable information is set to None
 #Stolen from https://gist.github.com/dplanella/5563018#file-gistfile2-py
 #See also: https://wiki.ubuntu.com/Novacut/GStreamer1.0
-def getVideoThumbnail(path):
-	pipeline = Gst.parse_launch('playbin')
+def probeMedia(path, thumbnail=False):
+	ret = {'duration': None, 'width': None, 'height': None, 'thumbnail': None}
+	pipeline = getProbePipeline()
 	pipeline.props.uri = 'file://' + os.path.abspath(path)
-	pipeline.props.audio_sink = Gst.ElementFactory.make('fakesink', 'fakeaudio')
-	pipeline.props.video_sink = Gst.ElementFactory.make('fakesink', 'fakevideo')
 	pipeline.set_state(Gst.State.PAUSED)
-	# Wait for state change to finish.
-	pipeline.get_state(Gst.CLOCK_TIME_NONE)
-	sample = pipeline.emit('convert-sample', Gst.Caps.from_string('image/jpeg'))
-	if sample == None:
-		raise IOError('Not a video');
-	ret = sample.get_buffer() #Note: Don't merge this line with the line above. Somehow, it doesn't work! (probably because of C voodoo)
-	pipeline.set_state(Gst.State.NULL)
-	return ret.extract_dup(0, ret.get_size())
-
-def getVideoDimension(path):
-	pipeline = Gst.parse_launch('playbin')
-	pipeline.props.uri = 'file://' + os.path.abspath(path)
-	pipeline.props.audio_sink = Gst.ElementFactory.make('fakesink', 'fakeaudio')
-	pipeline.props.video_sink = Gst.ElementFactory.make('fakesink', 'fakevideo')
-	pipeline.set_state(Gst.State.PAUSED)
-	pipeline.get_state(Gst.CLOCK_TIME_NONE)
-	pad = pipeline.props.video_sink.get_static_pad('sink')
-	caps = pad.get_current_caps()
-	if caps == None:
+	try:
+		# Wait for state change to finish.
+		pipeline.get_state(Gst.CLOCK_TIME_NONE)
+		sec = pipeline.query_duration(Gst.Format.TIME)[1]/10**9
+		if sec != 0: #TODO: zero-length media doesn't mean that it isn't a media file. Should use a smarter way to detect it.
+			ret['duration'] = sec
+		caps = pipeline.props.video_sink.get_static_pad('sink').get_current_caps()
+		if caps != None:
+			struct = caps.get_structure(0)
+			ret['width'], ret['height'] = struct.get_int('width')[1], struct.get_int('height')[1]
+		if thumbnail:
+			sample = pipeline.emit('convert-sample', Gst.Caps.from_string('image/jpeg'))
+			if sample != None:
+				buf = sample.get_buffer() #Note: Don't merge this line with the line above. Somehow, it doesn't work! (probably because of C voodoo)
+				ret['thumbnail'] = buf.extract_dup(0, buf.get_size())
+	finally:
 		pipeline.set_state(Gst.State.NULL)
-		raise IOError('Not a video file');
-	struct = caps.get_structure(0)
-	ret = (str(struct.get_int('width')[1]), str(struct.get_int('height')[1]))
-	pipeline.set_state(Gst.State.NULL)
 	return ret
 
-def getMediaDuration(path):
-	pipeline = Gst.parse_launch('playbin')
-	pipeline.props.uri = 'file://' + os.path.abspath(path)
-	pipeline.props.audio_sink = Gst.ElementFactory.make('fakesink', 'fakeaudio')
-	pipeline.props.video_sink = Gst.ElementFactory.make('fakesink', 'fakevideo')
-	pipeline.set_state(Gst.State.PAUSED)
-	pipeline.get_state(Gst.CLOCK_TIME_NONE)
-	sec = pipeline.query_duration(Gst.Format.TIME)[1]/10**9
-	if sec == 0: #TODO: zero-length media doesn't mean that it isn't a media file. Should use a smarter way to detect it.
-		pipeline.set_state(Gst.State.NULL)
-		raise IOError('Not a video/music file');
-	secStr = '{0:d}:{1:02d}'.format(int(sec/60), int(sec%60))
-	pipeline.set_state(Gst.State.NULL)
-	return secStr
+#The orientation tag in the EXIF data of the APP1 segment of JPEG. 1 if it is not found
+def getExifOrientation(data):
+	if data[:6] != b'Exif\x00\x00':
+		return 1
+	tiff = data[6:]
+	order = '<' if tiff[:2] == b'II' else '>'
+	try:
+		offset = struct.unpack(order+'I', tiff[4:8])[0]
+		for i in range(struct.unpack(order+'H', tiff[offset:offset+2])[0]): #Entries of IFD0
+			tag, valueType, count, value = struct.unpack(order+'HHIH', tiff[offset+2+i*12:offset+12+i*12])
+			if tag == 0x0112:
+				return value
+	except struct.error:
+		pass
+	return 1
+
+#Read the size of JPEG from the SOF segment. The size is rotated by the EXIF orientation. None if the SOF segment isn't found before the image data
+def readJpegSize(f):
+	f.seek(2)
+	orientation = None #The orientation of the first EXIF APP1 segment. The other APP1 segments, e.g. XMP, are skipped
+	while True:
+		marker = f.read(2)
+		if len(marker) < 2 or marker[0] != 0xff:
+			return None
+		while marker[1] == 0xff: #Fill bytes
+			marker = marker[1:]+f.read(1)
+			if len(marker) < 2:
+				return None
+		if marker[1] == 0x01 or 0xd0 <= marker[1] <= 0xd8: #Markers without a segment
+			continue
+		if marker[1] in [0xd9, 0xda]: #End of image or start of the image data
+			return None
+		length = struct.unpack('>H', f.read(2))[0]
+		if 0xc0 <= marker[1] <= 0xcf and marker[1] not in [0xc4, 0xc8, 0xcc]: #Start of frame. DHT, JPG and DAC share the range
+			height, width = struct.unpack('>xHH', f.read(5))
+			if height == 0: #The height is defined by the DNL segment after the image data
+				return None
+			return (height, width) if orientation in [5, 6, 7, 8] else (width, height) #Orientation 5-8 are rotated by 90 degree
+		if marker[1] == 0xe1 and orientation == None:
+			data = f.read(length-2)
+			if data[:6] == b'Exif\x00\x00':
+				orientation = getExifOrientation(data)
+		else:
+			f.seek(length-2, 1)
+
+#Get the size of an image by reading its header only. The image is neither decoded nor kept open.
+#The size of JPEG is rotated by the EXIF orientation, which is the same as the size of the thumbnail. PIL is used for the other formats
+def getImageSize(path):
+	with open(path, 'rb') as f:
+		head = f.read(24)
+		if head[:8] == b'\x89PNG\r\n\x1a\n' and head[12:16] == b'IHDR':
+			return struct.unpack('>II', head[16:24])
+		if head[:2] == b'\xff\xd8':
+			try:
+				size = readJpegSize(f)
+			except struct.error: #Truncated file
+				size = None
+			if size != None:
+				return size
+	with Image.open(path) as im:
+		orientation = im.getexif().get(0x0112, 1) if im.format == 'JPEG' else 1
+		return (im.size[1], im.size[0]) if orientation in [5, 6, 7, 8] else im.size
+
+def formatDuration(sec):
+	return '{0:d}:{1:02d}'.format(int(sec/60), int(sec%60))
+
+##############################
+###Build statistics class###
+##############################
+#Records the time of each phase of a run, the counters of cache hits and misses, and the time of each file.
+#The statistics are always recorded because it is cheap. They are written only with -stats
+class BuildStats:
+	def __init__(self):
+		self.startTime = time.perf_counter()
+		self.phases = {} #phase name -> seconds
+		self.phaseOrder = []
+		self.currentPhase = None
+		self.phaseStartTime = None
+		self.counters = {}
+		self.files = {} #kind -> [number of files, total seconds, heap of (seconds, path) of the slowest files]
+
+	#End the current phase and start a new one. The time of a phase that occurs multiple times is summed
+	def phase(self, name):
+		now = time.perf_counter()
+		if self.currentPhase != None:
+			self.phases[self.currentPhase] += now-self.phaseStartTime
+		self.currentPhase = name
+		self.phaseStartTime = now
+		if name != None and name not in self.phases:
+			self.phases[name] = 0.0
+			self.phaseOrder.append(name)
+
+	def count(self, name, n=1):
+		self.counters[name] = self.counters.get(name, 0)+n
+
+	def fileTime(self, kind, path, seconds):
+		record = self.files.setdefault(kind, [0, 0.0, []])
+		record[0] += 1
+		record[1] += seconds
+		if len(record[2]) < STATS_SLOWEST_FILES:
+			heapq.heappush(record[2], (seconds, path))
+		elif STATS_SLOWEST_FILES > 0:
+			heapq.heappushpop(record[2], (seconds, path))
+
+	#Add the counters and the file times recorded in another process, i.e. a worker of pagePool
+	def merge(self, other):
+		for name, n in other.counters.items():
+			self.count(name, n)
+		for kind, (num, total, slowest) in other.files.items():
+			for seconds, path in slowest:
+				self.fileTime(kind, path, seconds)
+			record = self.files.setdefault(kind, [0, 0.0, []]) #No file is recorded above if STATS_SLOWEST_FILES is 0
+			record[0] += num-len(slowest)
+			record[1] += total-sum([seconds for seconds, path in slowest])
+
+	def report(self):
+		self.phase(None)
+		return {
+			'total': time.perf_counter()-self.startTime,
+			'phases': dict([(name, self.phases[name]) for name in self.phaseOrder]),
+			'counters': self.counters,
+			'files': dict([(kind, {'count': r[0], 'total': r[1], 'slowest': [{'path': path, 'seconds': seconds} for seconds, path in sorted(r[2], reverse=True)]}) for kind, r in self.files.items()]),
+		}
+
+	def save(self, path):
+		with open(path, 'w') as f:
+			json.dump(self.report(), f, indent='\t', sort_keys=False)
 
 ########################
 ###Database functions###
 ########################
 #Assumption:
-DATABASE_VERSION = 1
+DATABASE_VERSION = 2
 class DataEntity:
-	def __init__(self, mtime):
+	__slots__ = ['mtime', 'size', 'width', 'height', 'duration', 'format', 'hash'] #There is one entity per file. Without __dict__, it takes much less memory
+	#Besides mtime, the media information is cached so that unchanged files are not probed again.
+	#format is None if the media information is not probed yet. The other information is None if it is unavailable.
+	#hash is the content hash of the file. It is only calculated with -hash.
+	def __init__(self, mtime, size=None, width=None, height=None, duration=None, format=None, hash=None):
 		self.mtime = float(mtime)
-
+		self.size = size
+		self.width = width
+		self.height = height
+		self.duration = duration
+		self.format = format
+		self.hash = hash
+	def isProbed(self, mtime, size):
+		return self.format != None and self.mtime == mtime and self.size == size
+	def values(self):
+		return (self.mtime, self.size, self.width, self.height, self.duration, self.format, self.hash)
+
+#A dict that records the keys set or removed since the last call of clearChanges(), so that only the changes are written to the database
+#Note: an entry modified in place must be set again to be recorded
+class TrackedDict(dict):
+	def __init__(self, *args):
+		dict.__init__(self, *args)
+		self.clearChanges()
+		self.onChange = None #Called with (key, value) when a key is set and with (key,) when a key is removed. See Database.writeJournal()
+	def __setitem__(self, key, value):
+		dict.__setitem__(self, key, value)
+		self.changed.add(key)
+		self.removed.discard(key)
+		if self.onChange != None:
+			self.onChange(key, value)
+	def __delitem__(self, key):
+		dict.__delitem__(self, key)
+		self.changed.discard(key)
+		self.removed.add(key)
+		if self.onChange != None:
+			self.onChange(key)
+	def pop(self, key, *default):
+		if key in self:
+			self.changed.discard(key)
+			self.removed.add(key)
+			if self.onChange != None:
+				self.onChange(key)
+		return dict.pop(self, key, *default)
+	def update(self, *args):
+		for key, value in dict(*args).items():
+			self[key] = value
+	def clearChanges(self):
+		self.changed = set()
+		self.removed = set()
+	def markAllChanged(self):
+		self.changed = set(self)
+
+#The database stores:
+#  directories: rootRel -> (mtime, number of items) of each directory at the time the pages are generated. None if unknown
+#  data: path relative to <dest> -> DataEntity of each file
+#  pages: (rootRel, page number) -> (signature, set of dependencies, hash of the content) of each page. See detectChanges(), isPageOutdated() and generateHtml()
+#  conversions: outHref -> (status, mtime of the input file, command) of the last conversion of each converted file. See ConversionScheduler
+#  sprites: rootRel -> (sprite sheet -> signature, file name -> (sprite sheet, x, y, width, height)) of the sprite sheets of each directory. See generateSprites()
+#  covers: rootRel -> (number of covers selected, list of covers) of each directory. See getCovers()
+#Since version 2, the database is a SQLite database. Only the entries changed since the last save are written, in a single transaction, so that
+#saving a large gallery is cheap and an interrupted save never leaves a broken database behind.
+#The text databases of version 0 and 1 are converted on the first run. The text database is kept as database.v<version>.bak
+#Between two saves, every change is also appended to the journal(database.journal) as soon as it is made, i.e. once a thumbnail is generated, a file is probed, a conversion is finished or a page is generated.
+#If a run is interrupted, the journal is replayed on the next run, so that the finished work is not done again. The journal is removed once the changes are saved.
+#pendingChanges are the changes detected by a build(see detectChanges()) whose pages are not all generated yet. They are kept until the build is completed so that a resumed build still regenerates the pages
+#pagesDone are the pages already generated under pendingChanges. A resumed build skips them, unless they depend on a change added after they are generated
+DATABASE_SCHEMA = [
+	'CREATE TABLE IF NOT EXISTS meta(key TEXT PRIMARY KEY, value TEXT)',
+	'CREATE TABLE IF NOT EXISTS directories(rootRel TEXT PRIMARY KEY, mtime REAL, num INTEGER)',
+	'CREATE TABLE IF NOT EXISTS data(path TEXT PRIMARY KEY, mtime REAL, size INTEGER, width INTEGER, height INTEGER, duration REAL, format TEXT, hash TEXT)',
+	'CREATE TABLE IF NOT EXISTS pages(rootRel TEXT, pageNum INTEGER, signature TEXT, deps TEXT, hash TEXT, PRIMARY KEY(rootRel, pageNum))',
+	'CREATE TABLE IF NOT EXISTS conversions(outHref TEXT PRIMARY KEY, status TEXT, inMtime REAL, command TEXT)',
+	'CREATE TABLE IF NOT EXISTS sprites(rootRel TEXT PRIMARY KEY, sheets TEXT, offsets TEXT)',
+	'CREATE TABLE IF NOT EXISTS covers(rootRel TEXT PRIMARY KEY, count INTEGER, paths TEXT)',
+]
 class Database:
 	def __init__(self, filePath):
 		self.filePath = filePath
-		self.directories = ['']
+		self.directories = TrackedDict({'': None})
 		self.version = DATABASE_VERSION
 		self.templateCheckSum = 0
-		self.data = {}
-		f = open(filePath, 'r')
+		self.data = TrackedDict()
+		self.pages = TrackedDict()
+		self.conversions = TrackedDict()
+		self.sprites = TrackedDict()
+		self.covers = TrackedDict()
+		self.pendingChanges = set()
+		self.pagesDone = set()
+		self.connection = None
+		self.journalPath = filePath+'.journal' #None disables the journal, e.g. in the worker processes of pagePool
+		self.journalFile = None
+		f = open(filePath, 'rb')
+		header = f.read(16)
+		f.close()
+		if header == b'SQLite format 3\x00':
+			self.connection = sqlite3.connect(filePath)
+			self.load()
+		else:
+			self.loadText()
+			if not dryRun:
+				self.convert(len(header) > 0)
+		for d in [self.directories, self.data, self.pages, self.conversions, self.sprites, self.covers]:
+			d.clearChanges()
+		if os.path.exists(self.journalPath):
+			self.replayJournal()
+		for name in ['directories', 'data', 'pages', 'conversions', 'sprites', 'covers']:
+			getattr(self, name).onChange = self.journalChanges(name)
+
+	def load(self):
+		c = self.connection
+		meta = dict(c.execute('SELECT key, value FROM meta'))
+		self.version = int(meta.get('version', DATABASE_VERSION))
+		if self.version != DATABASE_VERSION:
+			raise Exception('Error: unsupported database version')
+		self.templateCheckSum = meta.get('templateCheckSum', 0)
+		self.pendingChanges = set([c for c in meta.get('pendingChanges', '').split('\t') if c != ''])
+		self.pagesDone = set([tuple(key) for key in json.loads(meta.get('pagesDone', '[]'))])
+		for rootRel, mtime, num in c.execute('SELECT rootRel, mtime, num FROM directories'):
+			self.directories[rootRel] = None if mtime == None else (mtime, num)
+		for row in c.execute('SELECT path, mtime, size, width, height, duration, format, hash FROM data'):
+			self.data[row[0]] = DataEntity(*row[1:])
+		for rootRel, pageNum, signature, deps, h in c.execute('SELECT rootRel, pageNum, signature, deps, hash FROM pages'):
+			self.pages[(rootRel, pageNum)] = (signature, set([d for d in deps.split('\t') if d != '']), h)
+		for outHref, status, inMtime, command in c.execute('SELECT outHref, status, inMtime, command FROM conversions'):
+			self.conversions[outHref] = (status, inMtime, command)
+		for rootRel, sheets, offsets in c.execute('SELECT rootRel, sheets, offsets FROM sprites'):
+			self.sprites[rootRel] = (json.loads(sheets), dict([(f, tuple(offset)) for f, offset in json.loads(offsets).items()]))
+		for rootRel, count, paths in c.execute('SELECT rootRel, count, paths FROM covers'):
+			self.covers[rootRel] = (count, [p for p in paths.split('\t') if p != ''])
+
+	#Load the text database of version 0 or 1. They only have the mtime of the files
+	def loadText(self):
+		f = open(self.filePath, 'r')
 		lines = f.read().splitlines() #Stolen from https://stackoverflow.com/questions/12330522/reading-a-file-without-newlines/12330535#12330535
 		f.close()
 		if len(lines) == 0:
@@ -186,33 +462,394 @@ class Database:
 			for root, dirs, files in os.walk(thumbnailPath):
 				rootRel = root[len(thumbnailPath)+1:]
 				for d in dirs:
-					self.directories.append(rootRelNoSlash(rootRel)+d)
+					self.directories[rootRelNoSlash(rootRel)+d] = None
 		elif self.version == 1:
 			self.templateCheckSum = lines[1]
 			lines = lines[2:]
 			if not '' in lines:
 				raise Exception('Error: Invalid database fotmat. Expecting an empty line.')
-			self.directories += lines[:lines.index('')]
+			for l in lines[:lines.index('')]:
+				self.directories[l] = None
 			for l in lines[lines.index('')+1:]:
 				cols = l.split('\t')
 				self.data[cols[0]] = DataEntity(cols[1])
 		else:
 			print('Error: unsupported database version')
+
+	#Replace the text database by a SQLite database with the same content
+	def convert(self, backup):
+		if backup:
+			backupPath = '{0}.v{1}.bak'.format(self.filePath, self.version)
+			print('Converting the database to version {0}. The old database is kept as {1}'.format(DATABASE_VERSION, backupPath))
+			os.replace(self.filePath, backupPath)
+		self.connection = sqlite3.connect(self.filePath)
+		with self.connection:
+			for statement in DATABASE_SCHEMA:
+				self.connection.execute(statement)
+		self.version = DATABASE_VERSION
+		for d in [self.directories, self.data, self.pages, self.conversions, self.sprites, self.covers]:
+			d.markAllChanged()
+		self.save()
+
+	#The onChange callback of the TrackedDict `name`, which journals its changes
+	def journalChanges(self, name):
+		return lambda key, *value: self.writeJournal((name, key)+value)
+
+	#Append a change to the journal. Each record is flushed at once so that it survives the script being killed
+	def writeJournal(self, record):
+		if self.journalPath == None or dryRun:
+			return
+		if self.journalFile == None:
+			self.journalFile = open(self.journalPath, 'ab')
+		self.journalFile.write(pickle.dumps(record))
+		self.journalFile.flush()
+
+	#Apply the changes in the journal left by an interrupted run and save them. The last record may be incomplete if the script was killed while writing it
+	def replayJournal(self):
+		records = []
+		with open(self.journalPath, 'rb') as f:
+			while True:
+				try:
+					records.append(pickle.load(f))
+				except (EOFError, pickle.UnpicklingError):
+					break
+		print('Resuming the interrupted run. {0} changes are recovered from {1}'.format(len(records), self.journalPath))
+		for record in records:
+			if record[0] == 'pendingChanges':
+				self.pendingChanges.update(record[2])
+				self.outdatePagesDone(record[2])
+			elif record[0] == 'pagesDone':
+				self.pagesDone.update(record[2])
+			elif len(record) == 3:
+				getattr(self, record[0])[record[1]] = record[2]
+			else:
+				getattr(self, record[0]).pop(record[1], None)
+		self.save()
+
+	#Record the changes of a build until it is completed. See pendingChanges
+	def addPendingChanges(self, changes):
+		changes = set(changes)-self.pendingChanges
+		if len(changes) > 0:
+			self.pendingChanges.update(changes)
+			self.writeJournal(('pendingChanges', None, changes))
+			self.outdatePagesDone(changes)
+
+	#Forget the generated pages which depend on `changes`, so that a resumed build generates them again. See pagesDone
+	def outdatePagesDone(self, changes):
+		self.pagesDone = set([key for key in self.pagesDone if key in self.pages and self.pages[key][1].isdisjoint(changes)])
+
+	#Record the generated pages `keys` until the build is completed. See pagesDone
+	#The pages showing the fallback of a conversion(i.e. depending on 'converted:<href>') are not recorded, so that a resumed build requests the conversion again
+	def addPagesDone(self, keys):
+		keys = set([key for key in keys if not any([dep.startswith('converted:') for dep in self.pages[key][1]])])-self.pagesDone
+		if len(keys) > 0:
+			self.pagesDone.update(keys)
+			self.writeJournal(('pagesDone', None, keys))
+
+	#Replace the directories by `directories`. Only the directories with a different state are recorded as changed
+	def setDirectories(self, directories):
+		for rootRel in list(self.directories):
+			if not rootRel in directories:
+				del self.directories[rootRel]
+		for rootRel, state in directories.items():
+			if self.directories.get(rootRel, False) != state:
+				self.directories[rootRel] = state
+
 	def save(self):
 		if verbose:
 			print('Saving database...')
 		if dryRun:
 			return
-		f = open(self.filePath, 'w')
-		f.write('{0}\n'.format(DATABASE_VERSION))
-		f.write('{0}\n'.format(self.templateCheckSum))
-		for item in self.directories:
-			if item != '':
-				f.write('{0}\n'.format(item))
-		f.write('\n')
-		for key in self.data:
-			f.write('{0}\t{1}\n'.format(key, self.data[key].mtime))
-		f.close()
+		with self.connection: #Commits all changes at once, or none of them if an exception is raised
+			c = self.connection
+			c.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)', [('version', str(DATABASE_VERSION)), ('templateCheckSum', str(self.templateCheckSum)), ('pendingChanges', '\t'.join(sorted(self.pendingChanges))), ('pagesDone', json.dumps(sorted(self.pagesDone)))])
+			c.executemany('DELETE FROM directories WHERE rootRel = ?', [(k,) for k in self.directories.removed])
+			c.executemany('INSERT OR REPLACE INTO directories VALUES (?, ?, ?)', [(k,)+(self.directories[k] or (None, None)) for k in self.directories.changed])
+			c.executemany('DELETE FROM data WHERE path = ?', [(k,) for k in self.data.removed])
+			c.executemany('INSERT OR REPLACE INTO data VALUES (?, ?, ?, ?, ?, ?, ?, ?)', [(k,)+self.data[k].values() for k in self.data.changed])
+			c.executemany('DELETE FROM pages WHERE rootRel = ? AND pageNum = ?', list(self.pages.removed))
+			c.executemany('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)', [k+(self.pages[k][0], '\t'.join(sorted(self.pages[k][1])), self.pages[k][2]) for k in self.pages.changed])
+			c.executemany('DELETE FROM conversions WHERE outHref = ?', [(k,) for k in self.conversions.removed])
+			c.executemany('INSERT OR REPLACE INTO conversions VALUES (?, ?, ?, ?)', [(k,)+tuple(self.conversions[k]) for k in self.conversions.changed])
+			c.executemany('DELETE FROM sprites WHERE rootRel = ?', [(k,) for k in self.sprites.removed])
+			c.executemany('INSERT OR REPLACE INTO sprites VALUES (?, ?, ?)', [(k, json.dumps(self.sprites[k][0]), json.dumps(self.sprites[k][1])) for k in self.sprites.changed])
+			c.executemany('DELETE FROM covers WHERE rootRel = ?', [(k,) for k in self.covers.removed])
+			c.executemany('INSERT OR REPLACE INTO covers VALUES (?, ?, ?)', [(k, self.covers[k][0], '\t'.join(self.covers[k][1])) for k in self.covers.changed])
+		for d in [self.directories, self.data, self.pages, self.conversions, self.sprites, self.covers]:
+			d.clearChanges()
+		#The changes are saved. The journal is no longer needed
+		if self.journalFile != None:
+			self.journalFile.close()
+			self.journalFile = None
+		if self.journalPath != None and os.path.exists(self.journalPath):
+			os.remove(self.journalPath)
+
+######################
+###Stat cache class###
+######################
+#Memoized metadata of the files for one run. On a network file system, each metadata call is a round-trip, so:
+#  Each directory is listed with os.scandir() once. Whether a file exists is answered by the listing of its directory
+#  The files of the directories scanned by scanDirs() and prefetch() are stat concurrently with a thread pool of STAT_THREADS threads
+#The files created or removed by this script must be reported with changed(). outputChanged() does it for the output files
+class StatCache:
+	def __init__(self, threads):
+		self.threads = threads
+		self.executor = None
+		self.executorPid = None
+		self.listings = {} #Path of a directory -> set of the names in it. Empty if the directory does not exist
+		self.stats = {} #Path -> os.stat_result, or None if it does not exist
+
+	#Same as map(), but the items are processed concurrently
+	def map(self, func, items):
+		if self.threads <= 1 or len(items) <= 1:
+			return list(map(func, items))
+		if self.executorPid != os.getpid(): #The threads are not inherited by the forked worker processes
+			self.executor = concurrent.futures.ThreadPoolExecutor(self.threads)
+			self.executorPid = os.getpid()
+		return list(self.executor.map(func, items))
+
+	#Stop the threads. They are started again if needed. Call it before forking, and at the end of the run
+	def close(self):
+		if self.executor != None and self.executorPid == os.getpid():
+			self.executor.shutdown()
+		self.executor = None
+		self.executorPid = None
+
+	#List the directories `paths` and stat the items inside. Both are done concurrently.
+	#Returns the list of (name, os.stat_result, whether it is a directory, whether it is a symbolic link) of the items of each directory. The symbolic links are followed by the stat
+	#If `fileStats` is False, only the directories are stat'ed, and the stat of the files is None
+	def scanDirs(self, paths, fileStats=True):
+		listings = self.map(listDirEntries, paths)
+		statted = [e for listing in listings for e in listing if fileStats or e.is_dir()]
+		stats = dict(zip([e.path for e in statted], self.map(lambda e: e.stat(), statted)))
+		ret = []
+		for path, listing in zip(paths, listings):
+			items = [(e.name, stats.get(e.path), e.is_dir(), e.is_symlink()) for e in listing]
+			self.listings[os.path.normpath(path)] = set([item[0] for item in items])
+			for item in items:
+				if item[1] != None:
+					self.stats[os.path.normpath(path+'/'+item[0])] = item[1]
+			ret.append(items)
+		return ret
+
+	def exists(self, path):
+		path = os.path.normpath(path)
+		if path in self.stats:
+			return self.stats[path] != None
+		directory, name = os.path.split(path)
+		if directory not in self.listings:
+			try:
+				self.listings[directory] = set([e.name for e in listDirEntries(directory)])
+			except (FileNotFoundError, NotADirectoryError):
+				self.listings[directory] = set()
+		return name in self.listings[directory]
+
+	#os.stat() of the file, or None if it does not exist
+	def stat(self, path):
+		path = os.path.normpath(path)
+		if path not in self.stats:
+			self.stats[path] = statOrNone(path) if self.exists(path) else None
+		return self.stats[path]
+
+	#Stat the files `paths` concurrently, so that the following stat() of them are answered immediately
+	def prefetch(self, paths):
+		paths = [os.path.normpath(path) for path in paths]
+		paths = [path for path in paths if path not in self.stats]
+		for path, st in zip(paths, self.map(statOrNone, paths)):
+			self.stats[path] = st
+
+	#Forget the metadata of the file `path`, which is written or removed
+	def changed(self, path, removed=False):
+		path = os.path.normpath(path)
+		self.stats.pop(path, None)
+		directory, name = os.path.split(path)
+		if directory in self.listings:
+			if removed:
+				self.listings[directory].discard(name)
+			else:
+				self.listings[directory].add(name)
+
+###########################
+###Directory index class###
+###########################
+class DirectoryIndexEntry:
+	def __init__(self, stat):
+		self.stat = stat #os.stat_result of the directory
+		self.dirs = {} #name -> os.stat_result of the subdirectories
+		self.files = {} #name -> os.stat_result of the files. None if the index has no file stats
+		self.num = None #Number of shown files, counted recursively. Cached by DirectoryIndex.itemsNum()
+
+#In-memory index of a directory tree. The tree is scanned once with `statCache` so that the pages are generated without touching the filesystem again.
+#The directories are identified by rootRel, the path relative to the root of the tree. The root itself is ''.
+#If `fileStats` is False, only the names of the files are indexed(e.g. the thumbnails), and the stat of the files is None. The directories are stat'ed in any case
+class DirectoryIndex:
+	def __init__(self, path, fileStats=True):
+		self.path = path
+		self.fileStats = fileStats
+		self.entries = {}
+		if os.path.isdir(path):
+			self.scan('', os.stat(path))
+
+	#Scan the directory rootRel. If `recursive` is True, the directories inside are scanned as well
+	def scan(self, rootRel, stat, recursive=True):
+		pending = [(rootRel, stat)]
+		while len(pending) > 0: #The directories of the same depth are scanned at once
+			listings = statCache.scanDirs([self.path+'/'+rootRel if rootRel != '' else self.path for rootRel, stat in pending], self.fileStats)
+			nextPending = []
+			for (rootRel, stat), items in zip(pending, listings):
+				entry = DirectoryIndexEntry(stat)
+				for name, st, isDir, isSymlink in items:
+					if isDir:
+						entry.dirs[name] = st
+						if recursive and not isSymlink: #Same as os.walk(), symbolic links to directories are listed but not followed
+							nextPending.append((rootRelNoSlash(rootRel)+name, st))
+					else:
+						entry.files[name] = st
+				self.entries[rootRel] = entry
+			pending = nextPending
+
+	#Rescan the directories `rootRels` without walking into their unchanged subdirectories. The new subdirectories are scanned recursively and the removed ones are dropped.
+	#Returns the set of rootRel of the directories scanned
+	def rescan(self, rootRels):
+		scanned = set()
+		for rootRel in sorted(rootRels, key=len): #The parent directories first
+			path = self.path+'/'+rootRel if rootRel != '' else self.path
+			if rootRel not in self.entries or not os.path.isdir(path): #Removed. It is handled by the rescan of the parent directory
+				continue
+			oldEntry = self.entries[rootRel]
+			self.scan(rootRel, os.stat(path), False)
+			entry = self.entries[rootRel]
+			scanned.add(rootRel)
+			for d in oldEntry.dirs:
+				subRootRel = rootRelNoSlash(rootRel)+d
+				if subRootRel in self.entries and (d not in entry.dirs or entry.dirs[d].st_ino != oldEntry.dirs[d].st_ino): #Removed or replaced
+					self.remove(subRootRel)
+			for d in entry.dirs:
+				subRootRel = rootRelNoSlash(rootRel)+d
+				if subRootRel not in self.entries and not os.path.islink(self.path+'/'+subRootRel):
+					self.scan(subRootRel, entry.dirs[d])
+					scanned.update([r for r, dirs, files in self.walk(subRootRel)])
+			for a in ancestors(rootRel):
+				self.entries[a].num = None
+		return set([r for r in scanned if r in self.entries])
+
+	#Remove the entries of the directory rootRel and the directories inside it
+	def remove(self, rootRel):
+		for r, dirs, files in list(self.walk(rootRel)):
+			del self.entries[r]
+
+	#Same as os.walk(), but the paths are relative and the order is sorted
+	def walk(self, rootRel=''):
+		stack = [rootRel]
+		while len(stack) > 0:
+			rootRel = stack.pop()
+			entry = self.entries[rootRel]
+			dirs = sorted(entry.dirs)
+			yield rootRel, dirs, sorted(entry.files)
+			stack += [rootRelNoSlash(rootRel)+d for d in reversed(dirs) if rootRelNoSlash(rootRel)+d in self.entries]
+
+	def itemsNum(self, rootRel):
+		if rootRel not in self.entries:
+			return 0
+		entry = self.entries[rootRel]
+		if entry.num == None:
+			entry.num = len([f for f in entry.files if isShownFile(f)]) + sum([self.itemsNum(rootRelNoSlash(rootRel)+d) for d in entry.dirs])
+		return entry.num
+
+	#Paths of all files inside the directory, recursively. The paths are relative to the root of the tree
+	def filesRecursive(self, rootRel):
+		return [rootRelNoSlash(r)+f for r, dirs, files in self.walk(rootRel) for f in files] if rootRel in self.entries else []
+
+################################
+###Conversion scheduler class###
+################################
+class ConversionJob:
+	def __init__(self, outHref, inFile, outFile, command, inMtime):
+		self.outHref = outHref
+		self.inFile = inFile
+		self.outFile = outFile
+		self.partialFile = getPartialFileName(outFile) #The command writes to this file. See getPartialFileName()
+		self.command = command
+		self.inMtime = inMtime
+		self.pages = set() #(rootRel, page number) of the pages waiting for the conversion
+		self.status = 'queued' #One of queued, running, done, failed and timeout
+		self.process = None
+		self.startTime = None
+
+#Run the conversion commands of `var convertedHref` in the background, with at most `maxJobs` commands at a time.
+#The results are recorded in database.conversions
+class ConversionScheduler:
+	def __init__(self, database, maxJobs, timeout):
+		self.database = database
+		self.maxJobs = maxJobs
+		self.timeout = timeout
+		self.jobs = {} #outHref -> ConversionJob submitted in this run
+		self.queue = []
+		self.running = []
+
+	def submit(self, job):
+		self.jobs[job.outHref] = job
+		self.queue.append(job)
+		self.poll()
+
+	#Reap the finished commands and start the queued ones
+	def poll(self):
+		for job in self.running[:]:
+			if job.process.poll() == None:
+				if self.timeout > 0 and time.time()-job.startTime > self.timeout:
+					print('Warning: conversion timed out: '+job.command)
+					os.killpg(job.process.pid, signal.SIGKILL) #Kill the whole command, not only the shell running it
+					job.process.wait()
+					self.finish(job, 'timeout')
+				continue
+			if job.process.returncode == 0:
+				if os.path.exists(job.partialFile):
+					os.replace(job.partialFile, job.outFile)
+					convertedFileList.add(job.outHref)
+					self.finish(job, 'done')
+				else:
+					print('Warning: command executed successfully but the output file is *not* found. Check your command executed: '+job.command)
+					self.finish(job, 'failed')
+			else:
+				self.finish(job, 'failed')
+
+		while len(self.queue) > 0 and len(self.running) < self.maxJobs:
+			job = self.queue.pop(0)
+			if verbose:
+				print('Converting '+job.inFile+'\n'+job.command)
+			if os.path.exists(job.outFile): #The outdated output
+				os.remove(job.outFile)
+				outputChanged(job.outHref, True)
+			if os.path.exists(job.partialFile):
+				os.remove(job.partialFile)
+			job.process = subprocess.Popen(job.command, shell=True, start_new_session=True) #In its own process group. See the timeout above
+			job.startTime = time.time()
+			job.status = 'running'
+			self.running.append(job)
+
+	def finish(self, job, status):
+		self.running.remove(job)
+		job.status = status
+		if status != 'done' and os.path.exists(job.partialFile):
+			#Conversion failed. Even if there's an output, it is useless. Don't use it!
+			os.remove(job.partialFile)
+		self.database.conversions[job.outHref] = (status, job.inMtime, job.command)
+		if status == 'done': #The pages showing the fallback are regenerated even if the build is interrupted before the regeneration. See getConvertedHref()
+			self.database.addPendingChanges(['converted:'+job.outHref])
+		if status == 'done':
+			outputChanged(job.outHref)
+		stats.count('conversions'+status.capitalize())
+		stats.fileTime('conversion', job.outHref, time.time()-job.startTime)
+
+	#Block until all conversions are finished
+	def wait(self):
+		while len(self.queue) > 0 or len(self.running) > 0:
+			time.sleep(0.1)
+			self.poll()
+
+	#(rootRel, page number) of the pages showing the fallback of a successful conversion
+	def pagesToRegenerate(self):
+		return set([key for job in self.jobs.values() if job.status == 'done' for key in job.pages])
 
 #################
 ###Match class###
@@ -234,27 +871,252 @@ class Match:
 	def __len__(self):
 		return len(self._matches)
 
+#################################
+###Template compilation classes###
+#################################
+#A compiled template is a tree. Each node list contains strings(literal text) and TemplateNode objects.
+class TemplateNode:
+	def __init__(self, tag, line, kind):
+		self.tag = tag #The Match object of the hgg tag
+		self.line = line
+		self.kind = kind
+		self.children = []
+		self.code = None #The pre-compiled condition of `if`
+	def location(self):
+		return ' in `'+self.tag.fullMatch()+'` at line '+str(self.line)
+
+class Template:
+	def __init__(self, path):
+		self.path = path
+		templateFile = open(path, 'r')
+		self.text = templateFile.read()
+		templateFile.close()
+		self.nodes = compileTemplate(self.text)
+		self.coverCount = getCoverCount(self.nodes)
+		self.usesPageCovers = hasNodeOfKind(self.nodes, 'thumbnails') #Whether the covers of the directory of the page are used, besides the ones of the subdirectories
+
+#The number of covers of a directory used by the template nodes, i.e. the largest index n of thumbnails[n] plus 1. The first cover is always used by `thumbnail` of the directories
+def getCoverCount(nodes):
+	count = 1
+	for node in nodes:
+		if type(node) == str:
+			continue
+		if node.kind == 'thumbnails':
+			count = max(count, node.index+1)
+		elif node.kind == 'var' and re.match(r'thumbnails\[\d+\]$', node.tag[1]):
+			count = max(count, int(node.tag[1][len('thumbnails['):-1])+1)
+		count = max(count, getCoverCount(node.children))
+	return count
+
+def hasNodeOfKind(nodes, kind):
+	return any([type(node) != str and (node.kind == kind or hasNodeOfKind(node.children, kind)) for node in nodes])
+
+#Compile the template text into a tree of TemplateNode. The template is parsed only once per run.
+def compileTemplate(template):
+	#Regex behavior: extrace <?hgg a b c?>. a b c is extracted as group 1,3,5 respectively
+	tags = [Match(i.group(0), i.group(1).split(), i.start(), i.end()) for i in re.finditer('<\?hgg\s*((\s+(.+?))+)\s*\?>', template)]
+
+	if len(tags) == 0:
+		print('Warning: your template contains no hgg tags at all. Are you using a wrong html file as a template file?')
+
+	root = []
+	stack = [] #The block nodes that are not yet terminated
+	pos = 0
+	line = 1
+	for tag in tags:
+		nodes = stack[-1].children if len(stack) > 0 else root
+		if tag.start() > pos:
+			nodes.append(template[pos:tag.start()])
+		line += template.count("\n", pos, tag.start())
+		pos = tag.end()
+		node = TemplateNode(tag, line, tag[0])
+		line += template.count("\n", tag.start(), tag.end())
+
+		if tag[0] in BLOCK_ELEMENTS and tag[-1] == 'end':
+			if len(stack) == 0 or stack[-1].kind != tag[0] or (tag[0] == 'for' and stack[-1].tag[1] != tag[1]):
+				raise Exception('Error: Unexpected end'+node.location())
+			stack.pop()
+			continue
+
+		if tag[0] == 'for':
+			if tag[1] not in ['path', 'files', 'pages']:
+				raise Exception('Error: Invalid for variable in template: `'+tag[1]+'`'+node.location())
+		elif tag[0] == 'if':
+			if len(stack) == 0: #Ensure that the if condition inside for loop
+				raise Exception('Error: if outside for loop:'+node.location())
+			try:
+				node.code = compile(tag[1], '<template line {0}>'.format(line), 'eval')
+			except SyntaxError:
+				raise Exception('Error: Invalid if expression'+node.location())
+		elif tag[0] == 'var':
+			if len(stack) == 0: #Ensure that var is inside for loop
+				raise Exception('Error: var outside for loop:'+node.location())
+			if tag[1] == 'convertedHref':
+				node.kind = 'convertedHref'
+		elif tag[0].find('thumbnails') == 0:
+			thumbnailIndex = re.match(r'thumbnails\[(\d+)\]$', tag[0])
+			if thumbnailIndex == None:
+				raise Exception('Error: Invalid thumbnails index'+node.location())
+			node.kind = 'thumbnails'
+			node.index = int(thumbnailIndex.group(1))
+		elif tag[0] not in ['fullTitle', 'title', 'num', 'mtime', 'pageNum', 'pageCount', 'prevPage', 'nextPage']:
+			raise Exception('Error: Invalid for identifier in template: '+tag[0]+node.location())
+
+		nodes.append(node)
+		if tag[0] in BLOCK_ELEMENTS:
+			stack.append(node)
+
+	if len(stack) > 0:
+		raise Exception('Error: Unterminated start: in '+stack[-1].tag[0]+' at line '+str(stack[-1].line))
+	if len(template) > pos:
+		root.append(template[pos:])
+	return root
+
 ##########################
 ###generation functions###
 ##########################
 
-#Returns true if the directory `rootRel` is updated.
+#Record an output file changed or removed in this run for -manifest. `path` is relative to <dest>
+def outputChanged(path, removed=False):
+	outputChanges[path] = 'removed' if removed else 'changed'
+	statCache.changed('{0}/{1}'.format(dest, path), removed)
+
+#Write the output files changed and removed in this run as JSON, so that only these files are deployed
+def saveManifest(path):
+	with open(path, 'w') as f:
+		json.dump(dict([(change, sorted([p for p, c in outputChanges.items() if c == change])) for change in ['changed', 'removed']]), f, indent='\t')
+
+#Replace `thumbnailFile` with a hard link to `storeFile`, so that the thumbnails of identical files share one file on disk
+#On the file systems without hard links(e.g. some FUSE, SMB and FAT mounts), the stored file is copied instead
+def linkThumbnail(storeFile, thumbnailFile):
+	if os.path.lexists(thumbnailFile):
+		os.remove(thumbnailFile)
+	try:
+		os.link(storeFile, thumbnailFile)
+	except OSError:
+		shutil.copyfile(storeFile, thumbnailFile)
+
+#The thumbnail directory of `density`, relative to <dest>
+def getThumbnailDir(density):
+	return 'thumbnails' if density == 1 else 'thumbnails@{0}x'.format(density)
+
+#The thumbnails of the file relFile(relative to <dest>/assets) as a list of (path relative to <dest>, suffix of the stored file, size, PIL format), from the largest to the smallest
+def getThumbnailOutputs(relFile):
+	outputs = []
+	for density in sorted(THUMBNAIL_DENSITIES, reverse=True):
+		thumbnailDir = getThumbnailDir(density)
+		size = (int(THUMBNAIL_SIZE[0]*density), int(THUMBNAIL_SIZE[1]*density))
+		outputs.append(('{0}/{1}.jpg'.format(thumbnailDir, relFile), thumbnailDir[len('thumbnails'):]+'.jpg', size, 'JPEG'))
+		if THUMBNAIL_WEBP:
+			outputs.append(('{0}/{1}.webp'.format(thumbnailDir, relFile), thumbnailDir[len('thumbnails'):]+'.webp', size, 'WEBP'))
+	return outputs
+
+#Generate the thumbnails of a single file. It may be run in a worker process of `thumbnailPool`.
+#`outputs` is the list returned by getThumbnailOutputs() with the paths prefixed by <dest>. The file is decoded once, and the image is shrunk from the largest output to the smallest one.
+#If `storeDir` is set, the thumbnails are stored in `storeDir` by its content hash and the thumbnail files are hard links to them. `contentHash` is calculated if it is not given.
+#Returns the media information obtained on the way, or None if no thumbnail is generated.
+def makeThumbnail(inFile, outputs, storeDir=None, contentHash=None):
+	fileExtension = os.path.splitext(inFile)[1].lower()
+	#TODO: implement music thumbnail support
+	#No thumbnail for misc file by design
+	if fileExtension not in SUPPORTED_IMAGE_FORMATS+SUPPORTED_VIDEO_FORMATS:
+		return None
+	try:
+		if storeDir != None:
+			if contentHash == None:
+				contentHash = fileHash(inFile)
+			storeFiles = ['{0}/{1}/{2}{3}'.format(storeDir, contentHash[:2], contentHash, suffix) for thumbnailFile, suffix, size, format in outputs]
+			if all([os.path.exists(storeFile) for storeFile in storeFiles]): #The thumbnails of an identical file are already generated. Only the media information is needed.
+				if fileExtension in SUPPORTED_IMAGE_FORMATS:
+					size = getImageSize(inFile)
+					info = {'width': size[0], 'height': size[1], 'duration': None}
+				else:
+					info = probeMedia(inFile)
+					del info['thumbnail']
+				for storeFile, output in zip(storeFiles, outputs):
+					linkThumbnail(storeFile, output[0])
+				info['hash'] = contentHash
+				return info
+
+		if fileExtension in SUPPORTED_IMAGE_FORMATS:
+			size = getImageSize(inFile)
+			info = {'width': size[0], 'height': size[1], 'duration': None}
+			im = Image.open(inFile)
+		else:
+			info = probeMedia(inFile, True)
+			if info['thumbnail'] == None:
+				raise IOError('Not a video')
+			im = Image.open(io.BytesIO(info.pop('thumbnail')))
+		if THUMBNAIL_DRAFT:
+			im.draft('RGB', outputs[0][2]) #No effect on non-JPEG images
+		if fileExtension in SUPPORTED_IMAGE_FORMATS:
+			im = ImageOps.exif_transpose(im) #Rotate the photos taken with a rotated camera
+		info['hash'] = contentHash
+		for i, (thumbnailFile, suffix, size, format) in enumerate(outputs):
+			RESIZE_BACKENDS[THUMBNAIL_RESIZE](im, size)
+			if storeDir == None:
+				if os.path.lexists(thumbnailFile): #It may be a hard link to a stored thumbnail. Don't overwrite the shared file
+					os.remove(thumbnailFile)
+				im.save(thumbnailFile, format)
+				continue
+			storeFile = storeFiles[i]
+			os.makedirs(os.path.dirname(storeFile), exist_ok=True)
+			im.save(storeFile+'.{0}.tmp'.format(os.getpid()), format)
+			os.replace(storeFile+'.{0}.tmp'.format(os.getpid()), storeFile) #Another process may be storing the same thumbnail at the same time
+			linkThumbnail(storeFile, thumbnailFile)
+		return info
+	except IOError:
+		print('Warning: failed generating thumbnail for '+inFile)
+	return None
+
+#Run makeThumbnail() and measure its time. It may be run in a worker process of `thumbnailPool`
+def timedMakeThumbnail(*args):
+	startTime = time.perf_counter()
+	info = makeThumbnail(*args)
+	return info, time.perf_counter()-startTime
+
+#Fill in the media information returned by timedMakeThumbnail() and put the entity into the database
+def storeThumbnailInfo(database, relInFile, entity, result):
+	info, seconds = result
+	if entity.format in SUPPORTED_IMAGE_FORMATS+SUPPORTED_VIDEO_FORMATS: #The other files have no thumbnail
+		stats.fileTime('thumbnail', relInFile, seconds)
+		stats.count('thumbnailsGenerated' if info != None else 'thumbnailsFailed')
+	if info == None:
+		return
+	entity.width, entity.height, entity.duration, entity.hash = info['width'], info['height'], info['duration'], info['hash']
+	database.data[relInFile] = entity
+	for output in getThumbnailOutputs(relInFile[len('assets/'):]):
+		outputChanged(output[0])
+
+#Update the database with the thumbnails generated by `thumbnailPool`.
+#If `wait` is False, only the finished jobs are collected. Otherwise, it blocks until all jobs are finished.
+def collectThumbnails(database, wait):
+	global lastDatabaseSaveTime
+	while len(pendingThumbnails) > 0 and (wait or pendingThumbnails[0][2].ready()):
+		relInFile, entity, result = pendingThumbnails.pop(0)
+		storeThumbnailInfo(database, relInFile, entity, result.get())
+		if time.time()-lastDatabaseSaveTime > DATABASE_FLUST_INTERVAL:
+			database.save()
+			lastDatabaseSaveTime = time.time()
+
+#If `thumbnailPool` is set, the thumbnails are generated asynchronously. Call collectThumbnails() to update the database.
 def generateThumbnails(dest, database, rootRel, files):
-	updated = False
 	for f in files:
 		#Generate thumbnails
 		relInFile = 'assets/{0}'.format(rootRelNoSlash(rootRel)+f) #Path to the inFile relative to <dest>
 		inFile = '{0}/{1}'.format(dest,relInFile)
 		thumbnailFile = '{0}/thumbnails/{1}.jpg'.format(dest, rootRelNoSlash(rootRel)+f)
+		outputs = [('{0}/{1}'.format(dest, output[0]),)+output[1:] for output in getThumbnailOutputs(rootRelNoSlash(rootRel)+f)]
 
-		mtime = os.path.getmtime(inFile)
-		#Check if thumbnail is already generated
-		if relInFile in database.data and database.data[relInFile].mtime == mtime and os.path.exists(thumbnailFile):
+		#Only images and videos have thumbnails. The media information of the other files is probed when the pages are generated. See getMediaInfo()
+		if os.path.splitext(inFile)[1].lower() not in SUPPORTED_IMAGE_FORMATS+SUPPORTED_VIDEO_FORMATS:
 			continue
-		updated = True
 
-		#Check for support of file format
-		if os.path.splitext(inFile)[1].lower() not in SUPPORTED_FORMATS and not SHOW_UNSUPPORTED_FORMATS:
+		st = assetIndex.entries[rootRel].files[f]
+		mtime = st.st_mtime
+		#Check if thumbnail is already generated
+		if relInFile in database.data and database.data[relInFile].mtime == mtime and all([statCache.exists(output[0]) for output in outputs]):
+			stats.count('thumbnailsUpToDate')
 			continue
 
 		if verbose:
@@ -263,323 +1125,1197 @@ def generateThumbnails(dest, database, rootRel, files):
 		if dryRun:
 			continue;
 
+		entity = DataEntity(mtime, st.st_size, format=os.path.splitext(inFile)[1].lower())
+		args = (inFile, outputs)
+		if hashMode:
+			args = (inFile, outputs, '{0}/store'.format(dest), fileHashes.get(relInFile))
+		if thumbnailPool == None:
+			storeThumbnailInfo(database, relInFile, entity, timedMakeThumbnail(*args))
+		else:
+			pendingThumbnails.append((relInFile, entity, thumbnailPool.apply_async(timedMakeThumbnail, args)))
+	if thumbnailPool != None:
+		collectThumbnails(database, False)
+
+#The file name of the sprite sheet `sheet` of the directory rootRel, relative to <dest>. See generateSprites()
+def getSpriteFileName(rootRel, sheet):
+	return 'sprites/{0}.{1}.jpg'.format(rootRel.replace('/','-') if rootRel != '' else 'index', sheet)
+
+#Pack the thumbnails of the files in the directory rootRel into sprite sheets of SPRITE_COLUMNS*SPRITE_ROWS thumbnails, in the order of the file names.
+#The files of each page(see getPageSlices()) are packed into their own sprite sheets, named '<page number>.<sprite sheet number in the page>', so that adding or removing a file doesn't move the thumbnails of the other pages
+#Each thumbnail is placed at the top-left corner of a cell of THUMBNAIL_SIZE. A sprite sheet is regenerated only if its files are changed. The thumbnails are looked up in the listing of the thumbnail directory, and the files are identified by the stats of the scan
+#Returns the list of the regenerated and removed sprite sheets
+def generateSprites(dest, database, rootRel):
+	thumbnailDir = '{0}/thumbnails/{1}'.format(dest, rootRel)
+	entry = assetIndex.entries[rootRel]
+	oldSheets, oldOffsets = database.sprites.get(rootRel, ({}, {}))
+	sheets = {}
+	offsets = {}
+	changedSheets = []
+	perSheet = SPRITE_COLUMNS*SPRITE_ROWS
+	for pageNum, (dirs, files) in enumerate(getPageSlices(entry.dirs, entry.files), 1):
+		members = [f for f in files if statCache.exists('{0}/{1}.jpg'.format(thumbnailDir, f))]
+		for sheetNum, i in enumerate(range(0, len(members), perSheet), 1):
+			sheet = '{0}.{1}'.format(pageNum, sheetNum)
+			sheetMembers = members[i:i+perSheet]
+			sheets[sheet] = hashlib.md5('\n'.join(['{0}\t{1}\t{2}'.format(f, entry.files[f].st_mtime, entry.files[f].st_size) for f in sheetMembers]).encode('utf-8', 'surrogateescape')).hexdigest()
+			spriteFile = '{0}/{1}'.format(dest, getSpriteFileName(rootRel, sheet))
+			if oldSheets.get(sheet) == sheets[sheet] and statCache.exists(spriteFile):
+				stats.count('spritesUpToDate')
+				offsets.update([(f, oldOffsets[f]) for f in sheetMembers if f in oldOffsets])
+				continue
+			changedSheets.append(sheet)
+			print('Generating sprite sheet: '+spriteFile)
+			if dryRun:
+				continue
+			offsets.update(makeSpriteSheet(spriteFile, thumbnailDir, sheet, sheetMembers))
+			outputChanged(spriteFile[len(dest)+1:])
+			stats.count('spritesGenerated')
+
+	#Remove the sprite sheets of the pages which have less thumbnails now
+	for sheet in oldSheets:
+		if sheet not in sheets:
+			spriteFile = '{0}/{1}'.format(dest, getSpriteFileName(rootRel, sheet))
+			if verbose:
+				print('Removing: '+spriteFile)
+			if not dryRun and statCache.exists(spriteFile):
+				os.remove(spriteFile)
+			outputChanged(spriteFile[len(dest)+1:], True)
+			changedSheets.append(sheet)
+	if len(changedSheets) > 0:
+		database.sprites[rootRel] = (sheets, offsets)
+	return changedSheets
+
+#Paste the thumbnails of the files `members` in thumbnailDir into the sprite sheet spriteFile
+#Returns file name -> (sprite sheet, x, y, width, height) of the pasted thumbnails
+def makeSpriteSheet(spriteFile, thumbnailDir, sheet, members):
+	offsets = {}
+	columns = min(len(members), SPRITE_COLUMNS)
+	image = Image.new('RGB', (columns*THUMBNAIL_SIZE[0], ((len(members)+columns-1)//columns)*THUMBNAIL_SIZE[1]))
+	for i, f in enumerate(members):
+		x, y = (i%columns)*THUMBNAIL_SIZE[0], (i//columns)*THUMBNAIL_SIZE[1]
 		try:
-			if os.path.splitext(inFile)[1].lower() in SUPPORTED_IMAGE_FORMATS:
-				im = Image.open(inFile)
-				im.thumbnail(THUMBNAIL_SIZE, Image.ANTIALIAS)
-				database.data[relInFile] = DataEntity(mtime)
-				im.save(thumbnailFile, 'JPEG')
-			elif os.path.splitext(inFile)[1].lower() in SUPPORTED_VIDEO_FORMATS:
-				im = Image.open(io.BytesIO(getVideoThumbnail(inFile)))
-				im.thumbnail(THUMBNAIL_SIZE, Image.ANTIALIAS)
-				database.data[relInFile] = DataEntity(mtime)
-				im.save(thumbnailFile, 'JPEG')
-			elif os.path.splitext(inFile)[1].lower() in SUPPORTED_MUSIC_FORMATS:
-				#TODO: implement music thumbnail support
-				#updated = True
-				pass
-			elif os.path.splitext(relInFile)[1].lower() in SUPPORTED_MISC_FORMATS:
-				pass #No thumbnail for misc file by design
+			with Image.open('{0}/{1}.jpg'.format(thumbnailDir, f)) as im:
+				image.paste(im, (x, y))
+				offsets[f] = (sheet, x, y, im.width, im.height)
 		except IOError:
-			print('Warning: failed generating thumbnail for '+inFile)
-	return updated
-
-def findEnd(template, startCondition, endCondition, tags, i):
-	assert tags[i][-1] == 'start'
-	j = i
-	recursionDepth = 1
-	while recursionDepth > 0:
-		j += 1
-		if j >= len(tags):
-			raise Exception('Error: Unterminated start: in '+tags[i][0]+' at line '+str(template.count("\n",0,tags[i].start())+1))
-		if startCondition(j):
-			recursionDepth += 1
-		elif endCondition(j):
-			recursionDepth -= 1
-
-	assert tags[j][-1] == 'end'
-	return j
-
-def parseHtml(dest, database, rootRel, dirs, files, template, tags, i, j=-1, var=''):
-	ret = ''
-	while i < len(tags) and (j == -1 or i < j):
-		if tags[i][0] == 'for': #Parse variable inside for loop
-			if tags[i][2] == 'start':
-				#Look for start-end pair of for loop
-				innerJ = findEnd(template, lambda j: tags[j] == tags[i], lambda j: tags[j][0] == 'for' and tags[j][1] == tags[i][1] and tags[j][2] == 'end', tags, i)
-
-				#generate the list of variables to be iterated thru the for loop
-				varList = []
-				if tags[i][1] == 'path':
-					varList.append({'href':'index.{0}'.format(webFormat), 'num': str(getDirectoryItemsNum('{0}/assets/'.format(dest)))})
-
-					dirPath = ''
-					for r in rootRel.split('/'):
-						if r == '': #''.split('/') returns ['']. We don't want this component.
-							continue
-						dirPath += r+'/'
-						varList.append({'title':escape(r), 'href':urllib.request.pathname2url('{0}.{1}'.format(dirPath[:-1], webFormat)).replace('/','-'), 'num': str(len(getFilesRecursive(lambda a,b,c,d:0, '{0}/assets/{1}'.format(dest, dirPath))))})
-				elif tags[i][1] == 'files':
-					for d in sorted(dirs):
-						prefix = '{0}/thumbnails'.format(dest)
-						thumbnailPaths = getFilesRecursive(lambda dp, dn, filenames, f:'./thumbnails/{0}'.format(os.path.join(dp, f)[len(prefix)+1:]), '{0}/{1}'.format(prefix, rootRelNoSlash(rootRel)+d))
-						thumbnailPaths = [i for i in thumbnailPaths if (os.path.splitext(i)[1].lower() in SUPPORTED_IMAGE_FORMATS+SUPPORTED_VIDEO_FORMATS)]
-						#shuffle the thumbnails so that the thumbnails generated is random
-						random.seed(SHUFFLE_SEED)
-						random.shuffle(thumbnailPaths)
-
-						hrefPath = '{0}.{1}'.format( (rootRelNoSlash(rootRel)+d).replace('/','-'), webFormat )
-						inFile = '{0}/assets/{1}'.format(dest, rootRelNoSlash(rootRel)+d)
-						mtime = time.strftime(TIME_FORMAT, time.gmtime(os.path.getmtime(inFile)))
-						size = humanReadable(os.path.getsize(inFile))
-						varList.append({'title':escape(d), 'href':urllib.request.pathname2url(hrefPath), 'num': str(getDirectoryItemsNum(inFile)), 'size': size, 'mtime': mtime, 'isDir':True, 'isImage':False, 'isVideo':False, 'isMusic':False, 'isMisc':False})
-						index=0
-						for t in thumbnailPaths:
-							varList[-1]['thumbnails[{0}]'.format(index)] = urllib.request.pathname2url(t)
-							index += 1
-						if len(thumbnailPaths) > 0:
-							varList[-1]['thumbnail'] = thumbnailPaths[0]
-					for f in sorted(files):
-						thumbnailPath = './thumbnails/{0}.jpg'.format(rootRelNoSlash(rootRel)+f)
-						hrefPath = 'assets/{0}'.format(rootRelNoSlash(rootRel)+f)
-						inFile = dest+'/'+hrefPath
-						#Check for support of file format
-						if os.path.splitext(inFile)[1].lower() not in SUPPORTED_FORMATS and not SHOW_UNSUPPORTED_FORMATS:
-							continue
-						mtime = time.strftime(TIME_FORMAT, time.gmtime(os.path.getmtime(inFile)))
-						size = humanReadable(os.path.getsize(inFile))
-						fileExtension = os.path.splitext(inFile)[1].lower()
-						varList.append({'title':escape(f), 'href':urllib.request.pathname2url(hrefPath), 'size': size, 'mtime': mtime, 'format':fileExtension, 'isDir':False, 'isImage':fileExtension in SUPPORTED_IMAGE_FORMATS, 'isVideo':fileExtension in SUPPORTED_VIDEO_FORMATS, 'isMusic':fileExtension in SUPPORTED_MUSIC_FORMATS, 'isMisc':fileExtension not in MEDIA_FORMATS})
-						try:
-							if varList[-1]['isImage']:
-								dimension=Image.open(inFile).size
-								varList[-1]['width'] = str(dimension[0])
-								varList[-1]['height'] = str(dimension[1])
-								varList[-1]['thumbnail'] = urllib.request.pathname2url(thumbnailPath)
-							elif varList[-1]['isVideo']:
-								varList[-1]['length'] = getMediaDuration(inFile)
-								varList[-1]['width'], varList[-1]['height'] = getVideoDimension(inFile)
-								varList[-1]['thumbnail'] = urllib.request.pathname2url(thumbnailPath)
-							elif varList[-1]['isMusic']:
-								varList[-1]['length'] = getMediaDuration(inFile)
-						except IOError:
-							print('Warning: failed generating parameters for '+inFile)
-				else:
-					raise Exception('Error: Invalid for variable in template: `'+tags[i][1]+'` in `'+tags[i].fullMatch()+'`'+' at line '+str(template.count("\n",0,tags[i].start())+1))
-
-				#Add common elements to varList(e.g. i)
-				for index in range(len(varList)):
-					varList[index]['i'] = index
-					varList[index]['isLast'] = (index==len(varList)-1)
-
-				#parse the things inside the for loop
-				for var in varList:
-					ret += template[tags[i].end():tags[i+1].start()]
-					ret += parseHtml(dest, database, rootRel, dirs, files, template, tags, i+1, innerJ, var)
-				i = innerJ
-		elif tags[i][0] == 'if': #Parse conditionally inside a for loop
-			if j == -1: #Ensure that the if condition inside for loop
-				raise Exception('Error: var outside for loop: in `'+tags[i].fullMatch()+'`'+' at line '+str(template.count("\n",0,tags[i].start())+1))
-			if tags[i][2] == 'start':
-				#Look for start-end pair of the if condition
-				innerJ = findEnd(template, lambda j: tags[j][0] == 'if' and tags[j][1] != 'end', lambda j: tags[j][0] == 'if' and tags[j][1] == 'end', tags, i)
-		
-				#parse the things inside the if condition
-				if bool(eval(tags[i][1], var)):
-					ret += template[tags[i].end():tags[i+1].start()]
-					ret += parseHtml(dest, database, rootRel, dirs, files, template, tags, i+1, innerJ, var)
-				i = innerJ
-		elif tags[i][0] == 'var': #Parse variable inside for loop
-			if j == -1: #Ensure that var is inside for loop
-				raise Exception('Error: var outside for loop: in `'+tags[i].fullMatch()+'`'+' at line '+str(template.count("\n",0,tags[i].start())+1))
-			if tags[i][1] == 'convertedHref':
-				format = tags[i][2]
-				inFile = '{0}/{1}'.format(dest, urllib.request.url2pathname(var['href']))
-				outHref = 'converted/{0}.{1}'.format(urllib.request.url2pathname(var['href'])[len('assets')+1:], format)
-				outFile = '{0}/{1}'.format(dest, outHref)
-				#If the file is already converted, use the existing converted file instead of reconverting it
-				if os.path.exists(outFile) and os.path.getmtime(outFile) >= os.path.getmtime(inFile):
-					if verbose:
-						print('Not converting up-to-date file: '+outHref)
-					ret += urllib.request.pathname2url(outHref)
-					convertedFileList.append(outFile[len(dest)+1:])
+			print('Warning: failed adding the thumbnail of {0} to the sprite sheet'.format(f))
+	image.save(spriteFile+'.tmp', 'JPEG')
+	os.replace(spriteFile+'.tmp', spriteFile)
+	return offsets
+
+#Get the DataEntity of a file with the media information. The file is probed only if the cached information is outdated.
+def getMediaInfo(database, relInFile, inFile, st):
+	entity = database.data.get(relInFile)
+	if entity != None and entity.isProbed(st.st_mtime, st.st_size):
+		stats.count('mediaInfoCached')
+		return entity
+	stats.count('mediaInfoProbed')
+	startTime = time.perf_counter()
+	fileExtension = os.path.splitext(inFile)[1].lower()
+	info = DataEntity(st.st_mtime, st.st_size, format=fileExtension)
+	if entity != None and entity.mtime == st.st_mtime:
+		info.hash = entity.hash
+	elif hashMode:
+		info.hash = fileHash(inFile)
+	try:
+		if fileExtension in SUPPORTED_IMAGE_FORMATS:
+			info.width, info.height = getImageSize(inFile)
+		elif fileExtension in SUPPORTED_VIDEO_FORMATS+SUPPORTED_MUSIC_FORMATS:
+			probed = probeMedia(inFile)
+			info.width, info.height, info.duration = probed['width'], probed['height'], probed['duration']
+	except IOError:
+		pass
+	stats.fileTime('probe', relInFile, time.perf_counter()-startTime)
+	#An outdated entity of an image or video means that its thumbnail failed to generate. Keep it so that the thumbnail is retried in the next run.
+	if entity == None or entity.mtime == st.st_mtime or fileExtension not in SUPPORTED_IMAGE_FORMATS+SUPPORTED_VIDEO_FORMATS:
+		database.data[relInFile] = info
+	return info
+
+#The rendering state of a page of a directory. `dirs` and `files` are the items shown in this page. See getPageSlices()
+class Page:
+	def __init__(self, rootRel, dirs, files, pageNum=1, pageCount=1):
+		self.rootRel = rootRel
+		self.dirs = dirs
+		self.files = files
+		self.pageNum = pageNum
+		self.pageCount = pageCount
+		self.deps = set() #The dependencies of the page. See detectChanges()
+	def key(self):
+		return (self.rootRel, self.pageNum)
+	#The signature of the items shown in the page. The number of pages is included only if the page shows it
+	def signature(self, withPageCount):
+		fileStats = assetIndex.entries[self.rootRel].files
+		items = [d+'/' for d in self.dirs]+['{0}\t{1}\t{2}'.format(f, fileStats[f].st_mtime, fileStats[f].st_size) for f in self.files]
+		if withPageCount:
+			items.append(str(self.pageCount))
+		return hashlib.md5('\n'.join(items).encode('utf-8', 'surrogateescape')).hexdigest()
+
+#The file name of the page `pageNum` of the directory rootRel, relative to <dest>
+def getHtmlFileName(rootRel, pageNum=1):
+	base = rootRel.replace('/','-') if rootRel != '' else 'index'
+	return '{0}.{1}'.format(base, webFormat) if pageNum == 1 else '{0}.page{1}.{2}'.format(base, pageNum, webFormat)
+
+#Split the shown items of a directory into pages of FILES_PER_PAGE items on average. Returns the list of (dirs, files) of each page.
+#A page ends at an item whose name hash hits, which depends on the name of the item only. Adding or removing an item changes only the page containing it,
+#unless a page reaches the maximum of FILES_PER_PAGE*4 items. Then the following pages up to the next hash boundary change as well
+def getPageSlices(dirs, files):
+	if FILES_PER_PAGE <= 0:
+		return [(sorted(dirs), getShownFiles(files))]
+	slices = [([], [])]
+	for isDir, names in [(True, sorted(dirs)), (False, getShownFiles(files))]:
+		for name in names:
+			slices[-1][0 if isDir else 1].append(name)
+			num = len(slices[-1][0])+len(slices[-1][1])
+			if num >= FILES_PER_PAGE*4 or zlib.crc32(name.encode('utf-8', 'surrogateescape')) % FILES_PER_PAGE == 0:
+				slices.append(([], []))
+	if len(slices) > 1 and slices[-1] == ([], []):
+		slices.pop()
+	return slices
+
+#rootRel and all of its parent directories
+def ancestors(rootRel):
+	ret = [rootRel]
+	while rootRel != '':
+		rootRel = rootRel[:rootRel.rfind('/')] if rootRel.rfind('/') != -1 else ''
+		ret.append(rootRel)
+	return ret
+
+#Compare the asset index with the database, and returns the set of changed dependencies. A dependency is one of:
+#  entries:<rootRel> -- the directory listing of rootRel, including the stat of the directory
+#  files:<rootRel> -- the files directly inside rootRel
+#  num:<rootRel> -- the number of items inside rootRel, counted recursively
+#  thumbs:<rootRel> -- the thumbnails inside rootRel, recursively
+#A page may also depend on:
+#  slice:<rootRel> -- the items shown in the page. It is outdated only if the signature of the page is changed. See isPageOutdated()
+#  pages:<rootRel> -- the number of pages of rootRel. It is included in the signature
+#  sprites:<rootRel>:<sprite sheet> -- a sprite sheet containing a thumbnail of the page. See generateSprites()
+#  sprites:<rootRel> -- any sprite sheet of rootRel, if a thumbnail of the page is not packed into a sprite sheet
+#The entities of removed files are removed from the database
+#With -hash, a file with the same size and content hash is regarded as unchanged even if its mtime is changed
+def detectChanges(database):
+	changes = set()
+	hashCandidates = []
+	def fileChanged(rootRel, f):
+		changes.add('files:'+rootRel)
+		if os.path.splitext(f)[1].lower() in SUPPORTED_IMAGE_FORMATS+SUPPORTED_VIDEO_FORMATS:
+			changes.update(['thumbs:'+a for a in ancestors(rootRel)])
+
+	for rootRel, dirs, files in assetIndex.walk():
+		entry = assetIndex.entries[rootRel]
+		state = database.directories.get(rootRel)
+		if state == None or state[0] != entry.stat.st_mtime: #A file or directory is added, removed or renamed
+			changes.add('entries:'+rootRel)
+			changes.update(['thumbs:'+a for a in ancestors(rootRel)])
+		if state == None or state[1] != assetIndex.itemsNum(rootRel):
+			changes.add('num:'+rootRel)
+		for f in files:
+			entity = database.data.get('assets/'+rootRelNoSlash(rootRel)+f)
+			if isShownFile(f) and (entity == None or entity.mtime != entry.files[f].st_mtime or (entity.size != None and entity.size != entry.files[f].st_size)):
+				if hashMode and entity != None and entity.hash != None and entity.size == entry.files[f].st_size: #(size, mtime) is only a pre-filter. The content may be unchanged
+					hashCandidates.append((rootRel, f))
 				else:
-					command = ' '.join(tags[i][3:-1]).format(i=shellEscape(inFile), o=shellEscape(outFile))
-					if verbose:
-						print('Converting '+inFile+'\n'+command)
-					if dryRun: #simulate a successful convertion in dry run
-						ret += urllib.request.pathname2url(outHref)
-						convertedFileList.append(outFile[len(dest)+1:])
-					else:
-						if os.path.exists(outFile):
-							os.remove(outFile)
-						if os.system(command) == 0:
-							if os.path.exists(outFile):
-								ret += urllib.request.pathname2url(outHref)
-								convertedFileList.append(outFile[len(dest)+1:])
-							else:
-								print('Warning: command executed successfully but the output file is *not* found. Check your command executed: '+command)
-								ret += tags[i][-1]
-						else:
-							#Conversion failed. Even if there's an output, it is useless. Don't use it!
-							if os.path.exists(outFile):
-								os.remove(outFile)
-							ret += tags[i][-1]
+					fileChanged(rootRel, f)
+
+	#Calculate the content hash of the files that are possibly changed
+	paths = ['{0}/assets/{1}'.format(dest, rootRelNoSlash(rootRel)+f) for rootRel, f in hashCandidates]
+	hashes = thumbnailPool.imap(fileHash, paths) if thumbnailPool != None else map(fileHash, paths)
+	for (rootRel, f), h in zip(hashCandidates, hashes):
+		relInFile = 'assets/'+rootRelNoSlash(rootRel)+f
+		st = assetIndex.entries[rootRel].files[f]
+		stats.count('filesHashed')
+		if database.data[relInFile].hash == h:
+			if verbose:
+				print('Content unchanged: '+relInFile)
+			stats.count('filesContentUnchanged')
+			entity = database.data[relInFile]
+			entity.mtime = st.st_mtime
+			database.data[relInFile] = entity
+		else:
+			fileHashes[relInFile] = h
+			fileChanged(rootRel, f)
+
+	for relInFile in list(database.data):
+		rootRel, f = os.path.split(relInFile[len('assets/'):])
+		if rootRel not in assetIndex.entries or f not in assetIndex.entries[rootRel].files:
+			fileChanged(rootRel, f)
+			del database.data[relInFile]
+	for key in list(database.pages):
+		if key[0] not in assetIndex.entries:
+			del database.pages[key]
+	for rootRel in list(database.sprites):
+		if rootRel not in assetIndex.entries:
+			del database.sprites[rootRel]
+	for rootRel in list(database.covers):
+		if rootRel not in assetIndex.entries:
+			del database.covers[rootRel]
+	return changes
+
+#The directories that possibly have outdated pages because of the changes. The pages are checked one by one with isPageOutdated()
+def getOutdatedPages(database, changes):
+	dependents = {}
+	for key in database.pages:
+		for dep in database.pages[key][1]:
+			dependents.setdefault(dep, []).append(key[0])
+	update = set([rootRel for rootRel in assetIndex.entries if (rootRel, 1) not in database.pages])
+	for dep in changes:
+		update.update(dependents.get(dep, []))
+		if dep.find('files:') == 0 or dep.find('entries:') == 0:
+			update.update(dependents.get('slice:'+dep[dep.find(':')+1:], []))
+	return update
+
+#Whether the page is to be generated because of the changes. If `force` is True, every page is generated, e.g. for a new template
+#The pages already generated by an interrupted run of the same build are generated again only if their items are changed. See Database.pagesDone
+def isPageOutdated(database, page, changes, force=False):
+	if page.key() not in database.pages:
+		return True
+	signature, deps, h = database.pages[page.key()]
+	if page.key() not in database.pagesDone and (force or not deps.isdisjoint(changes)):
+		return True
+	return 'slice:'+page.rootRel in deps and signature != page.signature('pages:'+page.rootRel in deps)
+
+#The covers of the directory rootRel: the first `coverCount` thumbnails of the directory tree in the shuffled order, relative to <dest>/thumbnails.
+#The covers are selected once and cached in the database until the thumbnails of the tree are changed. See build()
+def getCovers(dest, database, rootRel):
+	covers = database.covers.get(rootRel)
+	if covers != None and covers[0] >= coverCount:
+		stats.count('coversCached')
+		if COVER_MOSAIC > 0 and len(covers[1]) > 0 and not statCache.exists('{0}/{1}'.format(dest, getMosaicFileName(rootRel))):
+			generateMosaic(dest, rootRel, covers[1])
+		return covers[1][:coverCount]
+	stats.count('coversSelected')
+	thumbnailPaths = [t for t in thumbnailIndex.filesRecursive(rootRel) if t.endswith('.jpg') and isThumbnailOfAsset(t)] #Skip the WebP thumbnails and the thumbnails of the removed files
+	#shuffle the thumbnails so that the thumbnails generated is random
+	random.seed(SHUFFLE_SEED)
+	random.shuffle(thumbnailPaths)
+	database.covers[rootRel] = (coverCount, thumbnailPaths[:coverCount])
+	if COVER_MOSAIC > 0:
+		generateMosaic(dest, rootRel, thumbnailPaths[:coverCount])
+	return thumbnailPaths[:coverCount]
+
+#Select the covers used by the pages of the directories `rootRels` and generate their mosaics. It is done in the main process before `pagePool` is started,
+#so that the workers only read the cached covers. Otherwise several workers may select the covers and generate the mosaic of the same directory at the same time
+def prepareCovers(dest, template, database, rootRels):
+	for rootRel in rootRels:
+		if template.usesPageCovers:
+			getCovers(dest, database, rootRel)
+		for d in assetIndex.entries[rootRel].dirs:
+			getCovers(dest, database, rootRelNoSlash(rootRel)+d)
+
+#Whether the thumbnail `thumbnailRel` relative to <dest>/thumbnails is of an existing file. The thumbnails of the removed files are kept until the garbage collection
+def isThumbnailOfAsset(thumbnailRel):
+	rootRel, f = os.path.split(thumbnailRel[:-len('.jpg')])
+	return rootRel in assetIndex.entries and f in assetIndex.entries[rootRel].files
+
+#The file name of the cover mosaic of the directory rootRel, relative to <dest>
+def getMosaicFileName(rootRel):
+	return 'covers/{0}.jpg'.format(rootRel.replace('/','-') if rootRel != '' else 'index')
+
+#Composite the covers into a mosaic of THUMBNAIL_SIZE with COVER_MOSAIC*COVER_MOSAIC cells. The covers are repeated if there are not enough covers
+def generateMosaic(dest, rootRel, covers):
+	mosaicFile = '{0}/{1}'.format(dest, getMosaicFileName(rootRel))
+	if len(covers) == 0:
+		if not dryRun and statCache.exists(mosaicFile):
+			os.remove(mosaicFile)
+			outputChanged(mosaicFile[len(dest)+1:], True)
+		return
+	print('Generating mosaic: '+mosaicFile)
+	if dryRun:
+		return
+	cellSize = (THUMBNAIL_SIZE[0]//COVER_MOSAIC, THUMBNAIL_SIZE[1]//COVER_MOSAIC)
+	mosaic = Image.new('RGB', (cellSize[0]*COVER_MOSAIC, cellSize[1]*COVER_MOSAIC))
+	for i in range(COVER_MOSAIC*COVER_MOSAIC):
+		try:
+			with Image.open('{0}/thumbnails/{1}'.format(dest, covers[i%len(covers)])) as im:
+				mosaic.paste(ImageOps.fit(im.convert('RGB'), cellSize), ((i%COVER_MOSAIC)*cellSize[0], (i//COVER_MOSAIC)*cellSize[1]))
+		except IOError:
+			print('Warning: failed adding {0} to the mosaic'.format(covers[i%len(covers)]))
+	mosaic.save(mosaicFile+'.{0}.tmp'.format(os.getpid()), 'JPEG')
+	os.replace(mosaicFile+'.{0}.tmp'.format(os.getpid()), mosaicFile)
+	outputChanged(mosaicFile[len(dest)+1:])
+	stats.count('mosaicsGenerated')
+
+#Generate the list of variables of `for path`
+def getPathVarList(dest, page):
+	rootRel = page.rootRel
+	varList = [{'href':getHtmlFileName(''), 'num': str(assetIndex.itemsNum(''))}]
+	page.deps.add('num:')
+
+	dirPath = ''
+	for r in rootRel.split('/'):
+		if r == '': #''.split('/') returns ['']. We don't want this component.
+			continue
+		dirPath += r+'/'
+		varList.append({'title':escape(r), 'href':urllib.request.pathname2url(getHtmlFileName(dirPath[:-1])), 'num': str(assetIndex.itemsNum(dirPath[:-1]))})
+		page.deps.add('num:'+dirPath[:-1])
+	return varList
+
+#Generate the list of variables of `for pages`
+def getPagesVarList(page):
+	page.deps.update(['slice:'+page.rootRel, 'pages:'+page.rootRel])
+	return [{'href':urllib.request.pathname2url(getHtmlFileName(page.rootRel, n)), 'num':str(n), 'isCurrent':n == page.pageNum} for n in range(1, page.pageCount+1)]
+
+#Generate the variables of `for files` one by one, so that the memory usage doesn't grow with the size of the directory
+def iterFilesVars(dest, database, page):
+	rootRel, dirs, files = page.rootRel, page.dirs, page.files
+	entry = assetIndex.entries[rootRel]
+	page.deps.add('slice:'+rootRel)
+	for d in sorted(dirs):
+		page.deps.update([dep+rootRelNoSlash(rootRel)+d for dep in ['entries:', 'num:', 'thumbs:']])
+		thumbnailPaths = ['./thumbnails/'+t for t in getCovers(dest, database, rootRelNoSlash(rootRel)+d)]
+
+		hrefPath = getHtmlFileName(rootRelNoSlash(rootRel)+d)
+		mtime = time.strftime(TIME_FORMAT, time.gmtime(entry.dirs[d].st_mtime))
+		size = humanReadable(entry.dirs[d].st_size)
+		v = {'title':escape(d), 'href':urllib.request.pathname2url(hrefPath), 'num': str(assetIndex.itemsNum(rootRelNoSlash(rootRel)+d)), 'size': size, 'mtime': mtime, 'isDir':True, 'isImage':False, 'isVideo':False, 'isMusic':False, 'isMisc':False}
+		index=0
+		for t in thumbnailPaths:
+			v['thumbnails[{0}]'.format(index)] = urllib.request.pathname2url(t)
+			index += 1
+		if len(thumbnailPaths) > 0:
+			v['thumbnail'] = thumbnailPaths[0]
+			addThumbnailVars(v, thumbnailPaths[0][len('./thumbnails/'):])
+			if COVER_MOSAIC > 0:
+				v['mosaic'] = urllib.request.pathname2url(getMosaicFileName(rootRelNoSlash(rootRel)+d))
+		yield v
+	sprites = database.sprites.get(rootRel)
+	for f in getShownFiles(files):
+		thumbnailPath = './thumbnails/{0}.jpg'.format(rootRelNoSlash(rootRel)+f)
+		hrefPath = 'assets/{0}'.format(rootRelNoSlash(rootRel)+f)
+		inFile = dest+'/'+hrefPath
+		st = entry.files[f]
+		mtime = time.strftime(TIME_FORMAT, time.gmtime(st.st_mtime))
+		size = humanReadable(st.st_size)
+		fileExtension = os.path.splitext(inFile)[1].lower()
+		v = {'title':escape(f), 'href':urllib.request.pathname2url(hrefPath), 'size': size, 'mtime': mtime, 'format':fileExtension, 'isDir':False, 'isImage':fileExtension in SUPPORTED_IMAGE_FORMATS, 'isVideo':fileExtension in SUPPORTED_VIDEO_FORMATS, 'isMusic':fileExtension in SUPPORTED_MUSIC_FORMATS, 'isMisc':fileExtension not in MEDIA_FORMATS}
+		try:
+			info = getMediaInfo(database, hrefPath, inFile, st)
+			if v['isImage']:
+				if info.width == None:
+					raise IOError('Not an image file')
+				v['width'] = str(info.width)
+				v['height'] = str(info.height)
+				v['thumbnail'] = urllib.request.pathname2url(thumbnailPath)
+				addThumbnailVars(v, thumbnailPath[len('./thumbnails/'):])
+				addSpriteVars(v, page, sprites, f)
+			elif v['isVideo']:
+				if info.duration == None:
+					raise IOError('Not a video/music file')
+				if info.width == None:
+					raise IOError('Not a video file')
+				v['length'] = formatDuration(info.duration)
+				v['width'], v['height'] = str(info.width), str(info.height)
+				v['thumbnail'] = urllib.request.pathname2url(thumbnailPath)
+				addThumbnailVars(v, thumbnailPath[len('./thumbnails/'):])
+				addSpriteVars(v, page, sprites, f)
+			elif v['isMusic']:
+				if info.duration == None:
+					raise IOError('Not a video/music file')
+				v['length'] = formatDuration(info.duration)
+		except IOError:
+			print('Warning: failed generating parameters for '+inFile)
+		yield v
+
+#Add the variables of the thumbnails of other densities and formats, given the JPEG thumbnail `thumbnailRel` relative to <dest>/thumbnails
+def addThumbnailVars(v, thumbnailRel):
+	srcset = []
+	srcsetWebp = []
+	for density in sorted(THUMBNAIL_DENSITIES):
+		href = urllib.request.pathname2url('./{0}/{1}'.format(getThumbnailDir(density), thumbnailRel))
+		if density != 1:
+			v['thumbnail@{0}x'.format(density)] = href
+		srcset.append('{0} {1}x'.format(href, density))
+		srcsetWebp.append('{0}.webp {1}x'.format(href[:-len('.jpg')], density))
+	v['srcset'] = ', '.join(srcset)
+	if THUMBNAIL_WEBP:
+		v['srcsetWebp'] = ', '.join(srcsetWebp)
+
+#Add the variables of the position of the thumbnail of the file `f` in the sprite sheets of the directory of the page
+#The page depends on the sprite sheet containing the thumbnail, or on all sprite sheets of the directory if the thumbnail is not packed yet
+#The signature of the sprite sheet is added to spriteUrl so that the browsers don't use the cached sprite sheet of a different layout
+def addSpriteVars(v, page, sprites, f):
+	if SPRITE_COLUMNS <= 0:
+		return
+	if sprites == None or f not in sprites[1]:
+		page.deps.add('sprites:'+page.rootRel)
+		return
+	sheet, x, y, width, height = sprites[1][f]
+	page.deps.add('sprites:{0}:{1}'.format(page.rootRel, sheet))
+	v['spriteUrl'] = urllib.request.pathname2url(getSpriteFileName(page.rootRel, sheet))+'?'+sprites[0][sheet][:8]
+	v['spriteX'], v['spriteY'], v['spriteWidth'], v['spriteHeight'] = str(x), str(y), str(width), str(height)
+
+#Check for support of file format
+def getShownFiles(files):
+	return [f for f in sorted(files) if isShownFile(f)]
+
+#The file that the command of a conversion writes to. It is renamed to `outFile` only if the command succeeds, so that an interrupted conversion never leaves a partial file that looks up-to-date.
+#The extension is kept because the commands may choose the format by it
+def getPartialFileName(outFile):
+	return '{0}/.partial.{1}'.format(os.path.dirname(outFile), os.path.basename(outFile))
+
+#Get the href of the file of `var` converted with the command of the convertedHref node.
+#If the converted file is outdated, the conversion is submitted to `converter` and the else expression is returned. The page is regenerated after the conversion is finished.
+def getConvertedHref(dest, page, node, var):
+	format = node.tag[2]
+	inFile = '{0}/{1}'.format(dest, urllib.request.url2pathname(var['href']))
+	outHref = 'converted/{0}.{1}'.format(urllib.request.url2pathname(var['href'])[len('assets')+1:], format)
+	outFile = '{0}/{1}'.format(dest, outHref)
+	inMtime = statCache.stat(inFile).st_mtime
+	outStat = statCache.stat(outFile)
+	#If the file is already converted, use the existing converted file instead of reconverting it
+	if outStat != None and outStat.st_mtime >= inMtime:
+		if verbose:
+			print('Not converting up-to-date file: '+outHref)
+		stats.count('conversionsUpToDate')
+		convertedFileList.add(outHref)
+		return urllib.request.pathname2url(outHref)
+
+	command = ' '.join(node.tag[3:-1]).format(i=shellEscape(inFile), o=shellEscape(getPartialFileName(outFile)))
+	if dryRun: #simulate a successful convertion in dry run
+		if verbose:
+			print('Converting '+inFile+'\n'+command)
+		convertedFileList.add(outHref)
+		return urllib.request.pathname2url(outHref)
+
+	page.deps.add('converted:'+outHref) #The fallback is shown until the conversion is finished
+	if outHref in converter.jobs:
+		converter.jobs[outHref].pages.add(page.key())
+		return node.tag[-1]
+	#Don't retry a failed conversion unless the input file or the command is changed
+	if outHref in converter.database.conversions and converter.database.conversions[outHref][0] != 'done':
+		status, lastInMtime, lastCommand = converter.database.conversions[outHref]
+		if lastInMtime == inMtime and lastCommand == command:
+			if verbose:
+				print('Not retrying {0} conversion: {1}'.format(status, outHref))
+			stats.count('conversionsNotRetried')
+			return node.tag[-1]
+	job = ConversionJob(outHref, inFile, outFile, command, inMtime)
+	job.pages.add(page.key())
+	converter.submit(job)
+	return node.tag[-1]
+
+#Render the compiled template nodes of `page`. The output is generated chunk by chunk
+def parseHtml(dest, database, page, nodes, var=None):
+	rootRel = page.rootRel
+	for node in nodes:
+		if type(node) == str:
+			yield node
+		elif node.kind == 'for': #Parse variable inside for loop
+			#generate the variables to be iterated thru the for loop
+			if node.tag[1] == 'path':
+				varList = getPathVarList(dest, page)
+				varNum = len(varList)
+			elif node.tag[1] == 'pages':
+				varList = getPagesVarList(page)
+				varNum = len(varList)
 			else:
-				try:
-					ret += var[tags[i][1]]
-				except KeyError:
-					if len(tags[i]) > 2 and tags[i][2]:
-						ret += tags[i][2]
-					else:
-						raise Exception('Error: the var '+tags[i][1]+' doesn\'t exist in `'+tags[i].fullMatch()+'`'+' at line '+str(template.count("\n",0,tags[i].start())+1)+'\n You may want to specify else expression')
-		elif tags[i][0] == 'fullTitle': #Parse the full title of the page
-			ret += rootRel if rootRel != '' else tags[i][1]
-		elif tags[i][0] == 'title': #Parse the title of the page
-			ret += escape( rootRel[:rootRel.rfind('/')] if rootRel.rfind('/') != -1 else (rootRel if rootRel != '' else tags[i][1]) )
-		elif tags[i][0] == 'num': #Parse the number of files in the page, recursively
-			ret += str(getDirectoryItemsNum('{0}/assets/{1}'.format(dest, rootRel)))
-		elif tags[i][0].find('thumbnails') == 0: #Parse the title of the page
-			prefix = '{0}/thumbnails'.format(dest)
-			thumbnailPaths = getFilesRecursive(lambda dp, dn, filenames, f:'./thumbnails/{0}'.format(os.path.join(dp, f)[len(prefix)+1:]), '{0}/{1}'.format(prefix, rootRel))
-			#shuffle the thumbnails so that the thumbnails generated is random
-			random.seed(SHUFFLE_SEED)
-			random.shuffle(thumbnailPaths)
-
-			thumbnailIndex = int(re.search(r'thumbnails\[(.+)\]', tags[i][0])[0])
+				varList = iterFilesVars(dest, database, page)
+				varNum = len(page.dirs)+len(getShownFiles(page.files))
+
+			#parse the things inside the for loop
+			for index, v in enumerate(varList):
+				#Add common elements to the variables(e.g. i)
+				v['i'] = index
+				v['isLast'] = (index==varNum-1)
+				yield from parseHtml(dest, database, page, node.children, v)
+		elif node.kind == 'if': #Parse conditionally inside a for loop
+			if bool(eval(node.code, var)):
+				yield from parseHtml(dest, database, page, node.children, var)
+		elif node.kind == 'convertedHref':
+			yield getConvertedHref(dest, page, node, var)
+		elif node.kind == 'var': #Parse variable inside for loop
+			try:
+				yield var[node.tag[1]]
+			except KeyError:
+				if len(node.tag) > 2 and node.tag[2]:
+					yield node.tag[2]
+				else:
+					raise Exception('Error: the var '+node.tag[1]+' doesn\'t exist'+node.location()+'\n You may want to specify else expression')
+		elif node.kind == 'fullTitle': #Parse the full title of the page
+			yield rootRel if rootRel != '' else node.tag[1]
+		elif node.kind == 'title': #Parse the title of the page
+			yield escape( rootRel[:rootRel.rfind('/')] if rootRel.rfind('/') != -1 else (rootRel if rootRel != '' else node.tag[1]) )
+		elif node.kind == 'num': #Parse the number of files in the page, recursively
+			yield str(assetIndex.itemsNum(rootRel))
+			page.deps.add('num:'+rootRel)
+		elif node.kind == 'thumbnails': #Parse the thumbnails of the page
+			thumbnailPaths = ['./thumbnails/'+t for t in getCovers(dest, database, rootRel)]
+			page.deps.add('thumbs:'+rootRel)
 			try:
-				ret += thumbnailPaths[thumbnailIndex]
+				yield thumbnailPaths[node.index]
 			except IndexError:
-				if len(tags[i]) >= 1 and tags[i][1]:
-					ret += tags[i][1]
+				if len(node.tag) > 1 and node.tag[1]:
+					yield node.tag[1]
 				else:
-					raise Exception('Error: the var '+tags[i][0]+' doesn\'t exist in `'+tags[i].fullMatch()+'`'+' at line '+str(template.count("\n",0,tags[i].start())+1)+'\n You may want to specify else expression')
-		elif tags[i][0] == 'mtime': #Parse the title of the page
-			ret += time.strftime(TIME_FORMAT, time.gmtime(os.path.getmtime('{0}/assets/{1}'.format(dest, rootRel))))
-		else:
-			raise Exception('Error: Invalid for identifier in template: '+tags[i][1]+' in '+tags[i].fullMatch()+' at line '+str(template.count("\n",0,tags[i].start())+1))
-
-		if i != len(tags)-1 and (j == -1 or i != j):
-			ret += template[tags[i].end():tags[i+1].start()]
-		i += 1
-	return ret
-
-def generateHtml(dest, template, database, rootRel, dirs, files):
-	htmlFilePath = '{0}/{1}.{2}'.format(dest, rootRel.replace('/','-'), webFormat) if rootRel != '' else '{0}/index.{1}'.format(dest, webFormat)
+					raise Exception('Error: the var '+node.tag[0]+' doesn\'t exist'+node.location()+'\n You may want to specify else expression')
+		elif node.kind == 'mtime': #Parse the mtime of the page
+			yield time.strftime(TIME_FORMAT, time.gmtime(assetIndex.entries[rootRel].stat.st_mtime))
+			page.deps.add('entries:'+rootRel)
+		elif node.kind in ['pageNum', 'pageCount']: #Parse the page number and the number of pages of the directory
+			yield str(page.pageNum if node.kind == 'pageNum' else page.pageCount)
+			page.deps.update(['slice:'+rootRel, 'pages:'+rootRel])
+		elif node.kind in ['prevPage', 'nextPage']: #Parse the href of the previous/next page
+			pageNum = page.pageNum-1 if node.kind == 'prevPage' else page.pageNum+1
+			page.deps.update(['slice:'+rootRel, 'pages:'+rootRel])
+			if pageNum >= 1 and pageNum <= page.pageCount:
+				yield urllib.request.pathname2url(getHtmlFileName(rootRel, pageNum))
+			elif len(node.tag) > 1 and node.tag[1]:
+				yield node.tag[1]
+			else:
+				raise Exception('Error: the '+node.tag[0]+' doesn\'t exist'+node.location()+'\n You may want to specify else expression')
+
+#`template` is a compiled Template object
+#The dependencies, the signature and the content hash of the page are recorded in the database.
+#If the content is identical to the existing page, the existing page is kept so that its mtime is not changed, e.g. for rsync
+def generateHtml(dest, template, database, page):
+	htmlFileName = getHtmlFileName(page.rootRel, page.pageNum)
+	htmlFilePath = '{0}/{1}'.format(dest, htmlFileName)
 	print('Generating HTML file: '+htmlFilePath)
-	templateFile = open(template, 'r')
-	template = templateFile.read()
-	templateFile.close()
-
-	#Regex behavior: extrace <?hgg a b c?>. a b c is extracted as group 1,3,5 respectively
-	tags = [Match(i.group(0), i.group(1).split(), i.start(), i.end()) for i in re.finditer('<\?hgg\s*((\s+(.+?))+)\s*\?>', template)]
-
-	if len(tags) == 0:
-		print('Warning: your template contains no hgg tags at all. Are you using a wrong html file as a template file?')
 
-	htmlFileBuffer = ''
-	htmlFileBuffer += template[:tags[0].start()]
-	htmlFileBuffer += parseHtml(dest, database, rootRel, dirs, files, template, tags, 0)
-	htmlFileBuffer += template[tags[-1].end():]
-
-	if not dryRun:
-		htmlFile = open(htmlFilePath, 'w')
-		htmlFile.write(htmlFileBuffer)
-		htmlFile.close()
+	startTime = time.perf_counter()
+	chunks = parseHtml(dest, database, page, template.nodes)
+	h = hashlib.blake2b(digest_size=16)
+	oldHash = database.pages[page.key()][2] if page.key() in database.pages else None
+	if dryRun:
+		for chunk in chunks:
+			h.update(chunk.encode('utf-8', 'surrogateescape'))
+		unchanged = h.hexdigest() == oldHash
+	else:
+		#The page is streamed to a temporary file, which replaces the old page only if the generation is completed
+		tmpFilePath = htmlFilePath+'.tmp'
+		try:
+			with open(tmpFilePath, 'w') as htmlFile:
+				for chunk in chunks:
+					h.update(chunk.encode('utf-8', 'surrogateescape'))
+					htmlFile.write(chunk)
+			unchanged = h.hexdigest() == oldHash and statCache.exists(htmlFilePath)
+			if not unchanged:
+				os.replace(tmpFilePath, htmlFilePath)
+		finally:
+			if os.path.exists(tmpFilePath): #The generation is failed, or the page is unchanged
+				os.remove(tmpFilePath)
+	database.pages[page.key()] = (page.signature('pages:'+page.rootRel in page.deps), page.deps, h.hexdigest())
+	if unchanged:
+		if verbose:
+			print('Content unchanged: '+htmlFilePath)
+		stats.count('pagesUnchanged')
+	else:
+		outputChanged(htmlFileName)
+	stats.count('pagesGenerated')
+	stats.fileTime('page', htmlFilePath[len(dest)+1:], time.perf_counter()-startTime)
+
+#Keep the arguments of generateHtml() in a worker process of `pagePool`. With fork, they are inherited instead of being pickled
+def initPageWorker(dest, template, database):
+	global pageWorkerArgs
+	database.journalPath = None #The changes are journaled by the main process. See storePageResult()
+	pageWorkerArgs = (dest, template, database)
+
+#With -j, start `pagePool` to generate the pages in parallel.
+#The workers are forked here so that they have the up-to-date database and indexes. Start a new pool after the database is changed by other means than the pages
+#`rootRels` are the directories of the pages to be generated by the pool
+def startPagePool(dest, template, database, rootRels):
+	global pagePool
+	if jobs > 1 and not dryRun:
+		prepareCovers(dest, template, database, rootRels)
+		statCache.close()
+		pagePool = multiprocessing.get_context('fork').Pool(jobs, initPageWorker, (dest, template, database))
+
+#Wait for the pages being generated by `pagePool` and stop it
+def finishPagePool(database):
+	global pagePool
+	if pagePool != None:
+		collectPages(database, True)
+		pagePool.close()
+		pagePool.join()
+		pagePool = None
+
+#Generate a page in a worker process of `pagePool`.
+#Returns the changes made by generateHtml(), which are applied to the main process by storePageResult()
+def renderPage(page):
+	global stats, converter, convertedFileList, outputChanges
+	dest, template, database = pageWorkerArgs
+	stats = BuildStats()
+	outputChanges = {}
+	converter = ConversionScheduler(database, 0, 0) #Records the conversions without running them. They are run by the converter of the main process
+	convertedFileList = set()
+	database.data.clearChanges()
+	database.pages.clearChanges()
+	database.covers.clearChanges()
+	generateHtml(dest, template, database, page)
+	return {
+		'data': dict([(key, database.data[key]) for key in database.data.changed]),
+		'pages': dict([(key, database.pages[key]) for key in database.pages.changed]),
+		'covers': dict([(key, database.covers[key]) for key in database.covers.changed]),
+		'conversions': list(converter.jobs.values()),
+		'convertedFiles': convertedFileList,
+		'outputChanges': outputChanges,
+		'stats': stats,
+	}
+
+#Apply the result of renderPage() to the database and submit the conversions requested by the page
+def storePageResult(database, result):
+	database.data.update(result['data'])
+	database.pages.update(result['pages'])
+	database.addPagesDone(result['pages'])
+	database.covers.update(result['covers'])
+	convertedFileList.update(result['convertedFiles'])
+	outputChanges.update(result['outputChanges'])
+	stats.merge(result['stats'])
+	for job in result['conversions']:
+		if job.outHref in converter.jobs: #Requested by another page as well
+			converter.jobs[job.outHref].pages.update(job.pages)
+		else:
+			converter.submit(job)
+
+#Update the database with the pages generated by `pagePool`.
+#If `wait` is False, only the finished pages are collected. Otherwise, it blocks until all pages are generated.
+def collectPages(database, wait):
+	while len(pendingPages) > 0 and (wait or pendingPages[0].ready()):
+		storePageResult(database, pendingPages.pop(0).get())
+	converter.poll()
+
+#Generate the pages of the directory rootRel for which isOutdated(page) is True, and remove the pages beyond the last page
+#If `pagePool` is set, the pages are generated asynchronously. Call collectPages() to update the database.
+def generateDirectory(dest, template, database, rootRel, isOutdated):
+	entry = assetIndex.entries[rootRel]
+	slices = getPageSlices(entry.dirs, entry.files)
+	for pageNum, (dirs, files) in enumerate(slices, 1):
+		page = Page(rootRel, dirs, files, pageNum, len(slices))
+		if not isOutdated(page):
+			stats.count('pagesUpToDate')
+		elif pagePool == None:
+			generateHtml(dest, template, database, page)
+			database.addPagesDone([page.key()])
+			converter.poll()
+		else:
+			pendingPages.append(pagePool.apply_async(renderPage, (page,)))
+	if pagePool != None:
+		collectPages(database, False)
 
-#Remove unused files
-def doGarbageCollection(dest, template, database, fullUpdate, update):
+	pageNum = len(slices)+1
+	while (rootRel, pageNum) in database.pages:
+		htmlFilePath = '{0}/{1}'.format(dest, getHtmlFileName(rootRel, pageNum))
+		if verbose:
+			print('Removing: '+htmlFilePath)
+		if not dryRun and statCache.exists(htmlFilePath):
+			os.remove(htmlFilePath)
+		outputChanged(getHtmlFileName(rootRel, pageNum), True)
+		del database.pages[(rootRel, pageNum)]
+		pageNum += 1
+
+#Remove unused files. The files to be removed are collected with one walk of each tree, then removed at once.
+#The unused converted files of existing files are removed only if `fullUpdate` is True, i.e. all pages are generated in this run so that convertedFileList is complete.
+def doGarbageCollection(dest, template, database, fullUpdate):
 	print('Doing garbage collection...')
 	assert os.path.exists(dest)
 
-	directoryList = []
-	filesList = []
-	for root, dirs, files in os.walk(assetsPath):
-		rootRel = root[len(assetsPath)+1:]
-		directoryList += [rootRelNoSlash(rootRel)+d for d in dirs]
-		filesList += [rootRelNoSlash(rootRel)+f for f in files]
-
-	#Looks for old directory layout for the removal of web files
-	currentDirectoryList = []
-
-	#Predict the current directory structure by the thumbnails. It assumes that the directory structure of the thumbnails is not modified.
-	#Note: it is different from oldDirectoryList. oldDirectoryList stores the previous directory layout in asset file(which doesn't include non-garbage collected files), while currentDirectoryList stores the current directory layout of thumbnails(and it assumes that the dicretory layout of converted is the same)(which include the non-garbage collected files). If garbage collection is enabled in the previous command, than both are identical.
-	thumbnailPath = dest+'/thumbnails'
-	for root, dirs, files in os.walk(thumbnailPath):
-		rootRel = root[len(thumbnailPath)+1:]
-		for d in dirs:
-			currentDirectoryList.append(rootRelNoSlash(rootRel)+d)
-
+	directorySet = set([rootRelNoSlash(rootRel)+d for rootRel, entry in assetIndex.entries.items() for d in entry.dirs])
+	filesSet = set([rootRelNoSlash(rootRel)+f for rootRel, entry in assetIndex.entries.items() for f in entry.files])
 
 	#Remove old database entities
-	for f in database.data.copy():
-		if f[len('assets/'):] not in filesList:
+	for f in list(database.data):
+		if f[len('assets/'):] not in filesSet:
 			del database.data[f]
+	for outHref in list(database.conversions):
+		if os.path.splitext(outHref[len('converted/'):])[0] not in filesSet:
+			del database.conversions[outHref]
 	database.save()
 
-	#Remove old web files
-	#FIXME: If the previous version of the template is in another format, then the old web files are not removed.
-	webFormat = os.path.splitext(template)[1][1:]
-	for d in currentDirectoryList:
-		if d not in directoryList:
-			oldFile = '{0}/{1}.{2}'.format(dest, d.replace('/','-'), webFormat)
-			if os.path.exists(oldFile):
-				if verbose:
-					print('Removing: '+oldFile)
-				if not dryRun:
-					os.remove(oldFile)
+	removedFiles = []
+	removedDirs = []
+	#The old directories found in the thumbnails. It assumes that the directory structure of the thumbnails is not modified. It is used for the removal of the web files
+	#Note: If garbage collection is enabled in the previous command, it is identical to the directories removed from the assets
+	oldDirectories = []
 
-	#Remove old thumbnails and converted files that the original version in <dest>/assets is deleted
-	#Note: do dest+'/thumbnails' last because it is used for old directory layout detection
-	for path in [dest+'/converted', dest+'/thumbnails']:
-		#Remove old files
-		for root, dirs, files in os.walk(path):
-			rootRel = root[len(path)+1:]
-			for f in files:
-				relFilePath = rootRelNoSlash(rootRel)+f
-				if os.path.splitext(relFilePath)[0] not in filesList and ( path != dest+'/converted' or 'converted/{0}'.format(relFilePath) not in convertedFileList): #os.path.splitext(relFilePath)[0] removes the file extension. For converted file, os.path.splitext(relFilePath)[0] may not work because it may have double file extension. Therefore, we need to check convertedFileList
-					oldFile = '{0}/{1}'.format(path,relFilePath)
-					if os.path.exists(oldFile):
-						if verbose:
-							print('Removing: '+oldFile)
-						if not dryRun:
-							os.remove(oldFile)
-		#Remove old directories
+	#Remove old thumbnails and converted files. The directories removed from the assets are removed without walking into them
+	for path in [dest+'/converted']+['{0}/{1}'.format(dest, getThumbnailDir(density)) for density in THUMBNAIL_DENSITIES]:
 		for root, dirs, files in os.walk(path):
 			rootRel = root[len(path)+1:]
 			for d in dirs:
 				relDirPath = rootRelNoSlash(rootRel)+d
-				if relDirPath not in directoryList:
-					oldFile = '{0}/{1}'.format(path,relDirPath)
-					if os.path.exists(oldFile):
-						if verbose:
-							print('Recursively removing: '+oldFile) #FIXME: This message will be printed multiple times in dry run
-						if not dryRun:
-							shutil.rmtree(oldFile)
-
-	#Remove unused converted files that the original version exists, but the converted version is unused
-	path = dest+'/converted'
-	for root, dirs, files in os.walk(path):
-		rootRel = root[len(path)+1:]
-		for f in files:
-			if ( fullUpdate or rootRel in update ) and 'converted/{0}'.format(f) not in convertedFileList:
-				oldFile = '{0}/converted/{1}'.format(dest,f)
-				if os.path.exists(oldFile):
-					if verbose:
-						print('Removing: '+oldFile)
-					if not dryRun:
-						os.remove(oldFile)
-
-convertedFileList = []
+				if relDirPath not in directorySet:
+					removedDirs.append('{0}/{1}'.format(path, relDirPath))
+					if path == dest+'/thumbnails':
+						oldDirectories.append(relDirPath)
+						for r, subDirs, subFiles in os.walk(path+'/'+relDirPath): #Only the directories inside are needed
+							oldDirectories += [r[len(path)+1:]+'/'+sd for sd in subDirs]
+			dirs[:] = [d for d in dirs if rootRelNoSlash(rootRel)+d in directorySet]
+			for f in files:
+				relFilePath = rootRelNoSlash(rootRel)+f
+				if path == dest+'/converted':
+					#os.path.splitext(relFilePath)[0] removes the file extension. For converted file, os.path.splitext(relFilePath)[0] may not work because it may have double file extension. Therefore, we need to check convertedFileList
+					if 'converted/'+relFilePath not in convertedFileList and (fullUpdate or os.path.splitext(relFilePath)[0] not in filesSet):
+						removedFiles.append('{0}/{1}'.format(path, relFilePath))
+				elif os.path.splitext(relFilePath)[0] not in filesSet:
+					removedFiles.append('{0}/{1}'.format(path, relFilePath))
+
+	#Remove old web files
+	#FIXME: If the previous version of the template is in another format, then the old web files are not removed.
+	for d in oldDirectories:
+		pageNum = 1
+		oldFile = '{0}/{1}'.format(dest, getHtmlFileName(d))
+		while statCache.exists(oldFile):
+			removedFiles.append(oldFile)
+			pageNum += 1
+			oldFile = '{0}/{1}'.format(dest, getHtmlFileName(d, pageNum))
+
+	for oldFile in removedFiles:
+		if verbose:
+			print('Removing: '+oldFile)
+		if not dryRun:
+			os.remove(oldFile)
+		outputChanged(oldFile[len(dest)+1:], True)
+	for oldDir in removedDirs:
+		if verbose:
+			print('Recursively removing: '+oldDir)
+		if not dryRun:
+			shutil.rmtree(oldDir)
+		outputChanged(oldDir[len(dest)+1:], True)
+
+	#Remove the sprite sheets of the removed directories and the old sprite sheets
+	spriteFiles = set([getSpriteFileName(rootRel, sheet) for rootRel, sprites in database.sprites.items() for sheet in sprites[0]]) if SPRITE_COLUMNS > 0 else set()
+	if os.path.isdir(dest+'/sprites'):
+		for f in os.listdir(dest+'/sprites'):
+			if 'sprites/'+f not in spriteFiles:
+				if verbose:
+					print('Removing: {0}/sprites/{1}'.format(dest, f))
+				if not dryRun:
+					os.remove('{0}/sprites/{1}'.format(dest, f))
+				outputChanged('sprites/'+f, True)
+
+	#Remove the mosaics of the removed directories
+	mosaicFiles = set([getMosaicFileName(rootRel) for rootRel in assetIndex.entries]) if COVER_MOSAIC > 0 else set()
+	if os.path.isdir(dest+'/covers'):
+		for f in os.listdir(dest+'/covers'):
+			if 'covers/'+f not in mosaicFiles:
+				if verbose:
+					print('Removing: {0}/covers/{1}'.format(dest, f))
+				if not dryRun:
+					os.remove('{0}/covers/{1}'.format(dest, f))
+				outputChanged('covers/'+f, True)
+
+	#Remove the stored thumbnails that are no longer linked by any thumbnail. It must be done after the thumbnails are removed
+	storeFiles = ['{0}/{1}'.format(root, f) for root, dirs, files in os.walk(dest+'/store') for f in files]
+	statCache.prefetch(storeFiles)
+	for oldFile in storeFiles:
+		if statCache.stat(oldFile).st_nlink == 1:
+			if verbose:
+				print('Removing: '+oldFile)
+			if not dryRun:
+				os.remove(oldFile)
+			outputChanged(oldFile[len(dest)+1:], True)
+
+#####################
+###Build functions###
+#####################
+#Generate the gallery. See generateGallery().
+#The worker pools are stopped even if the generation fails, so that a failed build with -watch does not leave them running with the results of the failed jobs
+def build(database, template, dirty=None):
+	try:
+		generateGallery(database, template, dirty)
+	finally:
+		stopPools()
+
+#Terminate the worker pools and drop the jobs pending in them. The pools are already finished if the build succeeds
+def stopPools():
+	global thumbnailPool, pagePool
+	for pool in [thumbnailPool, pagePool]:
+		if pool != None:
+			pool.terminate()
+			pool.join()
+	thumbnailPool = None
+	pagePool = None
+	del pendingThumbnails[:]
+	del pendingPages[:]
+	statCache.close()
+
+#The thumbnails and the pages are generated only if they are outdated.
+#If `dirty` is None, the whole assets directory is scanned. Otherwise, it is the set of rootRel of the directories changed since the last build(see watchGallery()), and only these directories are rescanned and checked for thumbnails
+def generateGallery(database, template, dirty=None):
+	global assetIndex, thumbnailIndex, converter, thumbnailPool, fileHashes, coverCount, statCache, lastDatabaseSaveTime
+	lastDatabaseSaveTime = time.time()
+	statCache = StatCache(STAT_THREADS) #The metadata is memoized for this run only
+	fileHashes = {}
+	outputChanges.clear()
+	fullUpdate = False #whether the gallery requires an full update
+
+	#Update the database if template is updated
+	templateCheckSum = hashlib.sha224(open(template, 'rb').read()).hexdigest()
+	if templateCheckSum != database.templateCheckSum or 'template' in database.pendingChanges: #'template' is pending if the build of a new template is interrupted
+		fullUpdate = True
+		database.templateCheckSum = templateCheckSum
+	compiledTemplate = Template(template) #Compile the template once. Errors of the template are reported before doing anything
+	coverCount = max(compiledTemplate.coverCount, COVER_MOSAIC*COVER_MOSAIC)
+
+	if jobs > 1 and not dryRun:
+		#fork is required because the script itself is not importable by the worker processes
+		thumbnailPool = multiprocessing.get_context('fork').Pool(jobs)
+
+	stats.phase('scan')
+	assetsPath = dest+'/assets'
+	if dirty == None or assetIndex == None:
+		print('Scanning assets...')
+		assetIndex = DirectoryIndex(assetsPath)
+		dirty = None
+	else:
+		print('Rescanning the changed directories...')
+		dirty = assetIndex.rescan(dirty)
+	changes = detectChanges(database) #Must be done before generating the thumbnails, which updates the database
+	changes.update(database.pendingChanges) #The changes of an interrupted build
+	if fullUpdate:
+		changes.add('template')
+	database.addPendingChanges(changes)
+	database.save() #The changes detected are saved before the database entries are updated, so that they are not lost if the build is interrupted
+	if shardCount > 0:
+		stats.phase('shards')
+		runShards(database, template)
+		statCache.close()
+		statCache = StatCache(STAT_THREADS) #The workers have created files unknown to the stat cache
+
+	stats.count('directories', len(assetIndex.entries))
+	stats.count('files', sum([len(e.files) for e in assetIndex.entries.values()]))
+	stats.phase('thumbnails')
+	print('Generating thumbnails in the following directories:')
+	for rootRel, dirs, files in assetIndex.walk():
+		if dirty != None and rootRel not in dirty:
+			continue
+		print('{0}/{1}'.format(assetsPath,rootRel))
+		for d in dirs: #Create the directories structure
+			for density in THUMBNAIL_DENSITIES:
+				mkdirIfNotExist('{0}/{1}/{2}'.format(dest, getThumbnailDir(density), rootRelNoSlash(rootRel)+d))
+			mkdirIfNotExist('{0}/converted/{1}'.format(dest,rootRelNoSlash(rootRel)+d))
+		generateThumbnails(dest, database, rootRel, files)
+		if time.time()-lastDatabaseSaveTime > DATABASE_FLUST_INTERVAL:
+			database.save()
+			lastDatabaseSaveTime = time.time()
+
+	if thumbnailPool != None:
+		print('Waiting for the thumbnails being generated...')
+		collectThumbnails(database, True)
+		thumbnailPool.close()
+		thumbnailPool.join()
+		thumbnailPool = None
+
+	if SPRITE_COLUMNS > 0:
+		stats.phase('sprites')
+		for rootRel in assetIndex.entries:
+			if dirty == None or rootRel in dirty:
+				changedSheets = generateSprites(dest, database, rootRel)
+				changes.update(['sprites:{0}:{1}'.format(rootRel, sheet) for sheet in changedSheets])
+				if len(changedSheets) > 0:
+					changes.add('sprites:'+rootRel)
+		database.addPendingChanges(changes)
+
+	#The covers are selected again if the thumbnails of the directory tree are changed
+	for rootRel in list(database.covers):
+		if regenWebFiles or 'thumbs:'+rootRel in changes:
+			del database.covers[rootRel]
+
+	stats.phase('pages')
+	update = getOutdatedPages(database, changes) #The set of rootRel of the directories with pages to be regenerated
+	resumed = len(database.pagesDone) > 0 #The pages generated by an interrupted run are skipped
+	if fullUpdate or len(update)>0 or regenWebFiles:
+		#Do generation and update of gallery
+		database.save()
+		if dirty == None or thumbnailIndex == None:
+			thumbnailIndex = DirectoryIndex('{0}/thumbnails'.format(dest), False) #Only the names of the thumbnails are used
+		else:
+			thumbnailIndex.rescan(dirty)
+		converter = ConversionScheduler(database, jobs, CONVERSION_TIMEOUT)
+		startPagePool(dest, compiledTemplate, database, assetIndex.entries if fullUpdate or regenWebFiles else update)
+		for rootRel, dirs, files in assetIndex.walk():
+			if regenWebFiles:
+				generateDirectory(dest, compiledTemplate, database, rootRel, lambda page: True)
+			elif fullUpdate or rootRel in update:
+				generateDirectory(dest, compiledTemplate, database, rootRel, lambda page: isPageOutdated(database, page, changes, fullUpdate))
+		finishPagePool(database)
+
+		if len(converter.jobs) > 0:
+			stats.phase('conversions')
+			print('Waiting for the conversions...')
+			converter.wait()
+			#Replace the fallbacks with the converted files
+			regenerate = converter.pagesToRegenerate()
+			stats.phase('pages')
+			startPagePool(dest, compiledTemplate, database, set([key[0] for key in regenerate]))
+			for rootRel in set([key[0] for key in regenerate]):
+				generateDirectory(dest, compiledTemplate, database, rootRel, lambda page: page.key() in regenerate)
+			finishPagePool(database)
+	else:
+		print('Gallery not updated. Not regenerating web files')
+	stats.phase('save')
+	#The directory states are saved only after all pages are generated so that the changes are not lost if the generation is interrupted
+	database.pendingChanges = set()
+	database.pagesDone = set()
+	database.setDirectories(dict([(rootRel, (assetIndex.entries[rootRel].stat.st_mtime, assetIndex.itemsNum(rootRel))) for rootRel in assetIndex.entries]))
+	database.save()
+
+	if garbageCollection:
+		stats.phase('gc')
+		doGarbageCollection(dest, template, database, regenWebFiles or (fullUpdate and not resumed))
+	statCache.close()
+
+	if statsPath != None:
+		stats.save(statsPath)
+		print('Statistics written to '+statsPath)
+	if manifestPath != None:
+		saveManifest(manifestPath)
+		print('Manifest written to '+manifestPath)
+	print('Generation completed!')
+
+#The shard of the directory rootRel in a build of `count` shards, from 1 to `count`. The directories are distributed by the hash of their paths so that the shards get a similar amount of work
+def getShard(rootRel, count):
+	return zlib.crc32(rootRel.encode('utf-8', 'surrogateescape'))%count+1
+
+#The database fragment written by the worker of a shard, which is merged by mergeShard()
+def getShardDatabasePath(shard, count):
+	return '{0}/database.shard{1}of{2}'.format(dest, shard, count)
+
+#Generate the thumbnails and the media information of the directories of a shard. Run by a worker of -shards, which may be on another node sharing <dest>.
+#The main database is only read. The updated entries are saved to the database fragment of the shard instead, together with the output changes and the statistics of the worker
+def buildShard(database, shard, count):
+	global assetIndex, thumbnailPool, statCache
+	statCache = StatCache(STAT_THREADS)
+	fragmentPath = getShardDatabasePath(shard, count)
+	if not dryRun:
+		for path in [fragmentPath, fragmentPath+'.journal']:
+			if os.path.exists(path):
+				os.remove(path)
+		createIfNotExist(fragmentPath)
+		database.connection.close()
+		database.connection = Database(fragmentPath).connection
+		database.journalPath = fragmentPath+'.journal'
+	if jobs > 1 and not dryRun:
+		thumbnailPool = multiprocessing.get_context('fork').Pool(jobs)
+
+	stats.phase('scan')
+	print('Scanning assets...')
+	assetIndex = DirectoryIndex(dest+'/assets')
+	shardDirs = [(rootRel, dirs, files) for rootRel, dirs, files in assetIndex.walk() if getShard(rootRel, count) == shard]
+
+	stats.phase('thumbnails')
+	print('Generating thumbnails of shard {0}/{1} in the following directories:'.format(shard, count))
+	for rootRel, dirs, files in shardDirs:
+		print('{0}/assets/{1}'.format(dest, rootRel))
+		if not dryRun: #The shard of the parent directory may not have created the directories yet
+			for density in THUMBNAIL_DENSITIES:
+				os.makedirs('{0}/{1}/{2}'.format(dest, getThumbnailDir(density), rootRel), exist_ok=True)
+			os.makedirs('{0}/converted/{1}'.format(dest, rootRel), exist_ok=True)
+		generateThumbnails(dest, database, rootRel, files)
+	if thumbnailPool != None:
+		print('Waiting for the thumbnails being generated...')
+		collectThumbnails(database, True)
+		thumbnailPool.close()
+		thumbnailPool.join()
+		thumbnailPool = None
+
+	#Probe the files without thumbnails as well so that the coordinator does not probe any file when generating the pages
+	stats.phase('probe')
+	for rootRel, dirs, files in shardDirs:
+		for f in getShownFiles(files):
+			relInFile = 'assets/{0}'.format(rootRelNoSlash(rootRel)+f)
+			getMediaInfo(database, relInFile, '{0}/{1}'.format(dest, relInFile), assetIndex.entries[rootRel].files[f])
+
+	stats.phase('save')
+	database.save()
+	if not dryRun:
+		with database.connection:
+			database.connection.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('shard', json.dumps({'outputChanges': outputChanges, 'counters': stats.counters, 'files': stats.files})))
+	statCache.close()
+	print('Shard {0}/{1} completed!'.format(shard, count))
+
+#Run the workers of the `shardCount` shards and wait for them. Each of them runs `hgg.py <dest> <template> -shard i/N`, as a local process or with SHARD_COMMAND
+#The database fragments of the workers are then merged into `database`
+def runShards(database, template):
+	args = [os.path.abspath(template)]
+	if verbose:
+		args.append('-v')
+	if dryRun:
+		args.append('-dry-run')
+	if hashMode:
+		args.append('-hash')
+	if jobs > 1:
+		args += ['-j', str(jobs)]
+	#Merge the fragments left by an interrupted build first, so that the workers do not redo the finished work
+	for f in sorted(os.listdir(dest)):
+		if re.match(r'database\.shard\d+of\d+$', f):
+			mergeShard(database, '{0}/{1}'.format(dest, f))
+	database.save()
+	print('Running {0} shards...'.format(shardCount))
+	processes = []
+	for shard in range(1, shardCount+1):
+		shardArgs = [os.path.abspath(dest)]+args+['-shard', '{0}/{1}'.format(shard, shardCount)]
+		if SHARD_COMMAND == None:
+			processes.append(subprocess.Popen([sys.executable, os.path.abspath(sys.argv[0])]+shardArgs))
+		else:
+			processes.append(subprocess.Popen(SHARD_COMMAND.format(i=shard, args=' '.join([shellEscape(a) for a in shardArgs])), shell=True))
+	failed = [shard for shard, process in enumerate(processes, 1) if process.wait() != 0]
+	for shard in range(1, shardCount+1): #Merge the fragments of the failed shards as well, so that their finished work is kept
+		mergeShard(database, getShardDatabasePath(shard, shardCount))
+	if len(failed) > 0:
+		raise Exception('Error: shard {0} of {1} failed'.format(', '.join([str(shard) for shard in failed]), shardCount))
+
+#Merge the database fragment of a shard into `database` and remove it. The journal of the fragment is replayed when it is opened if the worker was interrupted
+def mergeShard(database, fragmentPath):
+	if not os.path.exists(fragmentPath):
+		return
+	fragment = Database(fragmentPath)
+	database.data.update(fragment.data)
+	stats.count('shardEntities', len(fragment.data))
+	shardInfo = dict(fragment.connection.execute('SELECT key, value FROM meta')).get('shard')
+	if shardInfo != None: #It is None if the worker was interrupted
+		shardInfo = json.loads(shardInfo)
+		for path, change in shardInfo['outputChanges'].items():
+			outputChanged(path, change == 'removed')
+		workerStats = BuildStats()
+		workerStats.counters, workerStats.files = shardInfo['counters'], shardInfo['files']
+		stats.merge(workerStats)
+	fragment.connection.close()
+	if not dryRun:
+		os.remove(fragmentPath)
+
+#inotify(7) constants
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+
+#A minimal inotify(7) binding with ctypes
+class Inotify:
+	def __init__(self):
+		self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+		self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+		if self.fd < 0:
+			raise OSError(ctypes.get_errno(), 'inotify_init1() failed')
+		self.watches = {} #watch descriptor -> key
+
+	#Watch the directory `path`. The events of it are returned with `key`
+	def add(self, path, key, mask):
+		wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask|IN_ONLYDIR))
+		if wd < 0:
+			print('Warning: failed watching {0}: {1}'.format(path, os.strerror(ctypes.get_errno())))
+			return
+		self.watches[wd] = key
+
+	#Wait for at most `timeout` seconds(forever if None) and returns the list of (key, mask, name) of the events
+	#The watch of a removed directory is removed automatically, which is reported as IN_IGNORED. IN_Q_OVERFLOW is reported with the key None
+	def read(self, timeout):
+		if len(select.select([self.fd], [], [], timeout)[0]) == 0:
+			return []
+		data = os.read(self.fd, 65536)
+		events = []
+		pos = 0
+		while pos < len(data):
+			wd, mask, cookie, length = struct.unpack_from('iIII', data, pos)
+			name = os.fsdecode(data[pos+16:pos+16+length].rstrip(b'\0'))
+			pos += 16+length
+			if mask & IN_Q_OVERFLOW:
+				events.append((None, mask, name))
+			elif wd in self.watches:
+				events.append((self.watches.pop(wd) if mask & IN_IGNORED else self.watches[wd], mask, name))
+		return events
+
+	def close(self):
+		os.close(self.fd)
+
+#Generate the gallery, then keep regenerating it on the changes of the assets and the template until Ctrl-C is pressed.
+#The database and the directory indexes are kept in memory. Only the directories with inotify events are rescanned
+def watchGallery(database, template):
+	global regenWebFiles, stats
+	inotify = Inotify()
+	build(database, template)
+	regenWebFiles = False #Only the first generation is forced
+	templateDir = os.path.dirname(os.path.abspath(template))
+	inotify.add(templateDir, ('template', ''), IN_CLOSE_WRITE|IN_MOVED_TO) #Editors may replace the template by renaming a new file
+	watched = set()
+	try:
+		while True:
+			#Watch the new directories. Note: the files added before the watch is added are picked up in the next generation
+			for rootRel in set(assetIndex.entries)-watched:
+				inotify.add(dest+'/assets/'+rootRel if rootRel != '' else dest+'/assets', ('assets', rootRel), IN_MODIFY|IN_ATTRIB|IN_CLOSE_WRITE|IN_MOVED_FROM|IN_MOVED_TO|IN_CREATE|IN_DELETE)
+				watched.add(rootRel)
+			print('Watching for changes. Press Ctrl-C to stop')
+
+			dirty = set()
+			rescanAll = False
+			templateChanged = False
+			events = inotify.read(None)
+			while len(events) > 0: #Wait until no more changes are made for WATCH_DEBOUNCE seconds
+				for key, mask, name in events:
+					if key == None:
+						print('Warning: too many changes. Rescanning all assets')
+						rescanAll = True
+					elif key[0] == 'template':
+						templateChanged = templateChanged or os.path.join(templateDir, name) == os.path.abspath(template)
+					elif mask & IN_IGNORED: #The directory is removed or replaced. It is handled by the rescan of the parent directory
+						watched.discard(key[1])
+						dirty.add(ancestors(key[1])[1] if key[1] != '' else '')
+					else:
+						dirty.add(key[1])
+				events = inotify.read(WATCH_DEBOUNCE)
+
+			if len(dirty) == 0 and not rescanAll and not templateChanged:
+				continue
+			if verbose:
+				print('Changed directories: '+', '.join([dest+'/assets/'+rootRel for rootRel in sorted(dirty)]))
+			try:
+				stats = BuildStats()
+				build(database, template, None if rescanAll else dirty)
+			except Exception as e: #Keep watching. The user may fix the error, e.g. the template
+				print(e)
+				print('Warning: generation failed. Waiting for further changes')
+			if rescanAll:
+				watched = set([rootRel for rootRel in watched if rootRel in assetIndex.entries])
+	except KeyboardInterrupt:
+		print('Stopped watching')
+	finally:
+		inotify.close()
+
+convertedFileList = set() #outHref of the converted files used by the pages generated in this run
+outputChanges = {} #Path relative to <dest> -> 'changed' or 'removed' of the output files changed in this run. See outputChanged()
+converter = None #ConversionScheduler
+assetIndex = None #DirectoryIndex of <dest>/assets
+thumbnailIndex = None #DirectoryIndex of <dest>/thumbnails
+fileHashes = {} #relInFile -> content hash of the files hashed by detectChanges()
+statCache = StatCache(STAT_THREADS) #Memoized metadata of the files. It is replaced in each run of build()
+pendingThumbnails = [] #List of (relInFile, DataEntity, AsyncResult) of the thumbnails being generated by thumbnailPool
+thumbnailPool = None
+pendingPages = [] #List of AsyncResult of the pages being generated by pagePool
+pagePool = None
+coverCount = 1 #The number of covers of each directory to be selected. See getCovers()
+pageWorkerArgs = None #The arguments of generateHtml() in a worker process of pagePool. See initPageWorker()
+stats = BuildStats()
+jobs = 1
+shardCount = 0 #The number of shards of -shards, or of -shard in a worker
+shardIndex = None #The shard of a worker of -shards, from 1 to shardCount
 invalidArguments = False
 garbageCollection = False
 regenWebFiles = False
 dryRun = False
 verbose = False
 moveMode = False
+hashMode = False
+watchMode = False
+statsPath = None
+manifestPath = None
+profilePath = None
+
+VALUE_OPTIONS = ['j', 'stats', 'profile', 'manifest', 'shards', 'shard'] #Options that take the next argument as their value
+options = []
+parameters = []
+arguments = iter(sys.argv[1:])
+for a in arguments:
+	if a.find('-')==0:
+		options.append((a[1:], next(arguments, None) if a[1:] in VALUE_OPTIONS else None))
+	else:
+		parameters.append(a)
 
-options = [i[1:] for i in sys.argv[1:] if i.find('-')==0]
-for o in options:
+for o, value in options:
 	if o=='gc':
 		garbageCollection = True
 	elif o=='regen-web-files':
@@ -590,12 +2326,48 @@ for o in options:
 		verbose = True
 	elif o=='mv':
 		moveMode = True
+	elif o=='hash':
+		hashMode = True
+	elif o=='watch':
+		watchMode = True
+	elif o=='j':
+		try:
+			jobs = int(value)
+		except (TypeError, ValueError):
+			jobs = 0
+		if jobs < 1:
+			print('Option -j requires a positive number')
+			invalidArguments = True
+	elif o=='shards':
+		try:
+			shardCount = int(value)
+		except (TypeError, ValueError):
+			shardCount = 0
+		if shardCount < 1:
+			print('Option -shards requires a positive number')
+			invalidArguments = True
+	elif o=='shard':
+		try:
+			shardIndex, shardCount = [int(i) for i in value.split('/')]
+		except (AttributeError, ValueError):
+			shardIndex, shardCount = 0, 0
+		if not 1 <= shardIndex <= shardCount:
+			print('Option -shard requires a shard number i/N, where 1 <= i <= N')
+			invalidArguments = True
+	elif o in ['stats', 'profile', 'manifest']:
+		if value == None:
+			print('Option -'+o+' requires a file path')
+			invalidArguments = True
+		elif o == 'stats':
+			statsPath = value
+		elif o == 'manifest':
+			manifestPath = value
+		else:
+			profilePath = value
 	else:
 		print('Unknown option -'+o)
 		invalidArguments = True
 
-parameters = [i for i in sys.argv[1:] if i.find('-')!=0]
-
 if not invalidArguments and len(parameters) == 2:
 	if moveMode: # hgg.py -mv <srcFile> <destFile> [-v] [-dry-run]
 		srcFile, destFile = parameters
@@ -631,19 +2403,15 @@ if not invalidArguments and len(parameters) == 2:
 		relDestSuffix = destFileAbs[len(root+'/assets/'):] #Example: dd/ee/fff
 
 		database = Database('{0}/database'.format(root))
-		oldDatabaseData = dict(database.data)
-		database.data = {}
-		for i in oldDatabaseData:
+		for i in list(database.data):
 			if i.find(relSrc) == 0:
 				newKey = i.replace(relSrc, relDest, 1)
 				if verbose:
 					print('Database: {0} -> {1}'.format(i, newKey))
-				database.data[newKey] = oldDatabaseData[i]
-			else:
-				database.data[i] = oldDatabaseData[i]
+				database.data[newKey] = database.data.pop(i)
 
 		database.save()
-		for mid in ['thumbnails', 'converted', 'assets']: #Do 'assets' the last so that in case something goes wrong, the operation can be re-done
+		for mid in [getThumbnailDir(density) for density in THUMBNAIL_DENSITIES]+['converted', 'assets']: #Do 'assets' the last so that in case something goes wrong, the operation can be re-done
 			a = '{0}/{1}/{2}'.format(root, mid, relSrcSuffix)
 			b = '{0}/{1}/{2}'.format(root, mid, relDestSuffix)
 			if verbose:
@@ -654,27 +2422,42 @@ if not invalidArguments and len(parameters) == 2:
 		print('File/directory moved!')
 		if dryRun:
 			print('Note: This is a dry run. All operations above are not actually performed')
-	else: # hgg.py <dest> <template> [-v] [-gc] [-regen-web-files] [-dry-run]
+	else: # hgg.py <dest> <template> [-v] [-gc] [-regen-web-files] [-dry-run] [-j N] [-hash] [-watch] [-shards N] [-stats <file>] [-profile <file>] [-manifest <file>]
 		lastDatabaseSaveTime = time.time()
+		if profilePath != None:
+			profiler = cProfile.Profile()
+			profiler.enable()
 
 		dest, template = parameters
 
 		while len(dest) > 1 and dest[-1] == '/': #Remove the tailing /'s. Note that we won't remove the last / in case the user is spevifying / as the destination(what a stupid user!)
 			dest = dest[:-1]
 
+		if THUMBNAIL_RESIZE not in RESIZE_BACKENDS:
+			raise Exception('Error: Invalid THUMBNAIL_RESIZE in the configuration: '+THUMBNAIL_RESIZE)
+		if 1 not in THUMBNAIL_DENSITIES:
+			raise Exception('Error: THUMBNAIL_DENSITIES in the configuration must include 1')
+		if THUMBNAIL_WEBP and not features.check('webp'):
+			raise Exception('Error: THUMBNAIL_WEBP is enabled but PIL is built without WebP support')
+
+		stats.phase('initialize')
 		print('Initializing...')
 		mkdirIfNotExist(dest)
-		mkdirIfNotExist('{0}/thumbnails'.format(dest))
+		for density in THUMBNAIL_DENSITIES:
+			mkdirIfNotExist('{0}/{1}'.format(dest, getThumbnailDir(density)))
 		mkdirIfNotExist('{0}/assets'.format(dest))
 		mkdirIfNotExist('{0}/converted'.format(dest))
+		if hashMode:
+			mkdirIfNotExist('{0}/store'.format(dest))
+		if SPRITE_COLUMNS > 0:
+			mkdirIfNotExist('{0}/sprites'.format(dest))
+		if COVER_MOSAIC > 0:
+			mkdirIfNotExist('{0}/covers'.format(dest))
 
 		databasePath = '{0}/database'.format(dest)
 		createIfNotExist(databasePath)
 		database = Database(databasePath)
 
-		oldDirectoryList = database.directories[:]
-		newDirectoryList = []
-
 		readme = '{0}/README'.format(dest)
 		if not os.path.exists(readme):
 			if verbose:
@@ -683,61 +2466,21 @@ if not invalidArguments and len(parameters) == 2:
 				with open(readme, 'w') as f:
 					f.write(README_TEXT)
 
-		fullUpdate = False #whether the gallery requires an full update
-		update = []
-
-		#Update the database if template is updated
-		templateCheckSum = hashlib.sha224(open(template, 'rb').read()).hexdigest()
-		if templateCheckSum != database.templateCheckSum:
-			fullUpdate = True
-			database.templateCheckSum = templateCheckSum
-
-		print('Generating thumbnails in the following directories:')
-		assetsPath = dest+'/assets'
-		for root, dirs, files in os.walk(assetsPath):
-			rootRel = root[len(assetsPath)+1:]
-			print('{0}/{1}'.format(assetsPath,rootRel))
-			for d in dirs: #Create the directories structure
-				mkdirIfNotExist('{0}/thumbnails/{1}'.format(dest,rootRelNoSlash(rootRel)+d))
-				mkdirIfNotExist('{0}/converted/{1}'.format(dest,rootRelNoSlash(rootRel)+d))
-			if generateThumbnails(dest, database, rootRel, files) or update not in oldDirectoryList:
-				#if a new thumbnail is generated, add `rootRel` and its parents to `update`
-				update.append(rootRel)
-				parentPath = rootRel
-				while parentPath.rfind('/') != -1:
-					print(parentPath)
-					parentPath = parentPath[:parentPath.rfind('/')]
-					if parentPath not in update:
-						update.append(parentPath)
-				if '' not in update: #Since the content of rootRel is like `aa/bb/cc`, we need to add '' to the update list to make the index updated.
-					update.append('')
-			if time.time()-lastDatabaseSaveTime > DATABASE_FLUST_INTERVAL:
-				database.save()
-			newDirectoryList += [rootRelNoSlash(rootRel)+d for d in dirs]
-
-		if fullUpdate or len(update)>0 or regenWebFiles:
-			webFormat = os.path.splitext(template)[1][1:]
-			#Do generation and update of gallery
-			database.directories = newDirectoryList
-			database.save()
-			assetDir = '{0}/assets'.format(dest)
-			for root, dirs, files in os.walk(assetDir):
-				rootRel = root[len(assetDir)+1:]
-				if fullUpdate or rootRel in update or regenWebFiles:
-					generateHtml(dest, template, database, rootRel, dirs, files)
-
-			#Generate index page
-			files = os.listdir(assetDir)
+		webFormat = os.path.splitext(template)[1][1:]
+		if shardIndex != None:
+			buildShard(database, shardIndex, shardCount)
+		elif watchMode:
+			watchGallery(database, template)
 		else:
-			print('Gallery not updated. Not regenerating web files')
-
-		if garbageCollection:
-			doGarbageCollection(dest, template, database, fullUpdate, update)
+			build(database, template)
 
-		print('Generation completed!')
+		if profilePath != None:
+			profiler.disable()
+			profiler.dump_stats(profilePath)
+			print('Profile written to '+profilePath)
 		if dryRun:
 			print('Note: This is a dry run. All operations above are not actually performed')
 else:
 	print('HTML Gallery Generator')
-	print('Usage: '+sys.argv[0]+' <dest> <template> [-v] [-gc] [-regen-web-files] [-dry-run]')
+	print('Usage: '+sys.argv[0]+' <dest> <template> [-v] [-gc] [-regen-web-files] [-dry-run] [-j N] [-hash] [-watch] [-shards N] [-stats <file>] [-profile <file>] [-manifest <file>]')
 